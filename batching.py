@@ -0,0 +1,58 @@
+from constants import MAX_IMPORT_BYTES, MAX_IMPORT_COMMENTS, MAX_IMPORT_TICKETS
+
+BATCH_OVERHEAD = len('{"tickets": []}')
+
+
+class TicketBatch(object):
+    def __init__(self):
+        self.tickets = []  # (ticket_json, num_comments, tag) - tag is passed through for the caller, e.g. the ticket's page
+        self.num_bytes = BATCH_OVERHEAD
+        self.num_comments = 0
+
+    def fits(self, ticket_json, num_comments, max_bytes, max_comments, max_tickets):
+        separator = 1 if self.tickets else 0
+        return (len(self.tickets) < max_tickets and
+                self.num_bytes + separator + len(ticket_json) <= max_bytes and
+                self.num_comments + num_comments <= max_comments)
+
+    def add(self, ticket_json, num_comments, tag=None):
+        self.num_bytes += (1 if self.tickets else 0) + len(ticket_json)
+        self.num_comments += num_comments
+        self.tickets.append((ticket_json, num_comments, tag))
+
+    def tags(self):
+        return [tag for ticket_json, num_comments, tag in self.tickets]
+
+    def to_json(self):
+        return '{"tickets": [%s]}' % ','.join(ticket_json for ticket_json, num_comments, tag in self.tickets)
+
+
+def pack_tickets(tickets, max_bytes=MAX_IMPORT_BYTES, max_comments=MAX_IMPORT_COMMENTS, max_tickets=MAX_IMPORT_TICKETS):
+    """Pack (ticket_json, num_comments, tag) into as few batches as fit the budgets, largest first (first-fit decreasing).
+
+    Returns (batches, oversized) where oversized are the (ticket_json, tag) too big for any batch on their own.
+    """
+    batches = []
+    oversized = []
+    for ticket_json, num_comments, tag in sorted(tickets, key=lambda ticket: len(ticket[0]), reverse=True):
+        if BATCH_OVERHEAD + len(ticket_json) > max_bytes or num_comments > max_comments:
+            oversized.append((ticket_json, tag))
+            continue
+        for batch in batches:
+            if batch.fits(ticket_json, num_comments, max_bytes, max_comments, max_tickets):
+                batch.add(ticket_json, num_comments, tag)
+                break
+        else:
+            batch = TicketBatch()
+            batch.add(ticket_json, num_comments, tag)
+            batches.append(batch)
+    return batches, oversized
+
+
+def split_batch(batch):
+    """Split a batch in half, e.g. to retry one that was rejected or timed out."""
+    halves = (TicketBatch(), TicketBatch())
+    middle = len(batch.tickets) / 2
+    for i, (ticket_json, num_comments, tag) in enumerate(batch.tickets):
+        halves[i >= middle].add(ticket_json, num_comments, tag)
+    return halves
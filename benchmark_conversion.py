@@ -0,0 +1,72 @@
+"""Time desk_ticket_to_ZTicket on synthetic tickets, without any network calls.
+
+    python benchmark_conversion.py --messages 250 500 1000 2000
+    python benchmark_conversion.py --messages 1000 --profile
+"""
+import argparse
+import cProfile
+import datetime
+import pstats
+import time
+
+from main import AttachmentTuple, desk_ticket_to_ZTicket
+from zendesk_desk_models import Message, Ticket
+
+AGENT_ID = 1
+DESK_USER_ID = 100
+ZENDESK_USER_ID = 200
+
+
+def synthetic_ticket(num_messages, attachments_per_message=1):
+    """A Desk ticket with num_messages replies, and attachment tuples for every reply plus a few orphans."""
+    updated_at = datetime.datetime(2017, 1, 1)
+    ticket = Ticket({'id': 1, 'subject': 'Synthetic', 'priority': 5, 'status': 'open', 'created_at': updated_at,
+                     'user_id': DESK_USER_ID, 'num_replies': num_messages, 'num_notes': 0, 'num_attachments': 0}, strict=False)
+    ticket.messages = []
+    attachment_tuples = []
+    for i in xrange(num_messages):
+        message = Message({'direction': 'in' if i % 2 else 'out', 'body': 'Message body %d' % i, 'updated_at': updated_at,
+                           'status': 'sent', 'uri': '/api/v2/cases/1/replies/%d' % i, 'creator_id': DESK_USER_ID}, strict=False)
+        ticket.messages.append(message)
+        for j in xrange(attachments_per_message):
+            attachment_tuples.append(AttachmentTuple(token='token-%d-%d' % (i, j), message_uri=message.uri))
+    attachment_tuples.extend(AttachmentTuple(token='orphan-%d' % i, message_uri='') for i in xrange(3))
+    ticket.notes = []
+    return ticket, attachment_tuples
+
+
+def convert(ticket, attachment_tuples):
+    return desk_ticket_to_ZTicket(ticket=ticket, agent_id=AGENT_ID, attachment_tuples=attachment_tuples,
+                                  user_ids={DESK_USER_ID: ZENDESK_USER_ID})
+
+
+def time_conversion(num_messages, repeat):
+    ticket, attachment_tuples = synthetic_ticket(num_messages)
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        convert(ticket, attachment_tuples)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Desk to Zendesk ticket conversion.")
+    parser.add_argument("--messages", type=int, nargs='+', default=[250, 500, 1000, 2000], help="Message counts to time")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size; the best is reported")
+    parser.add_argument("--profile", action="store_true", help="Profile one conversion of the largest size")
+    options = parser.parse_args()
+    if options.profile:
+        ticket, attachment_tuples = synthetic_ticket(max(options.messages))
+        profiler = cProfile.Profile()
+        profiler.runcall(convert, ticket, attachment_tuples)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        return
+    for num_messages in options.messages:
+        elapsed = time_conversion(num_messages, options.repeat)
+        print '%5d messages: %8.1f ms (%.3f ms/message)' % (num_messages, elapsed * 1000, elapsed * 1000 / num_messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Compare item throughput under the logging setups main.py supports, with the same thread count as a migration.
+
+Each item logs the way the migration does per user/ticket, then does a little CPU work standing in for conversion.
+
+    python benchmark_logging.py --items 20000
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from constants import PROCESSES
+from main import configure_logging
+from multiprocessing.pool import ThreadPool
+
+SETUPS = [
+    # (name, log mode, level, sample every, per-item records at INFO with eager formatting as before)
+    ('plain, per-item INFO (before)', 'plain', 'INFO', 1, True),
+    ('plain, per-item DEBUG off', 'plain', 'INFO', 1, False),
+    ('plain, per-item DEBUG on', 'plain', 'DEBUG', 1, False),
+    ('structured, per-item DEBUG off', 'structured', 'INFO', 1, False),
+    ('structured, DEBUG sampled 1/100', 'structured', 'DEBUG', 100, False),
+    ('structured, DEBUG unsampled', 'structured', 'DEBUG', 1, False),
+]
+
+logger = logging.getLogger("migrate_to_zendesk")
+
+
+def item(i, eager):
+    payload = {'id': i, 'comments': range(20)}
+    if eager:
+        logger.info("Creating OR updating ticket: %d" % i)
+        logger.info("Successfully got image")
+        logger.info("Update payload: %s" % payload)
+    else:
+        logger.debug("Creating OR updating ticket: %d", i, extra={'ticket_id': i})
+        logger.debug("Successfully got image")
+        logger.debug("Update payload: %s", payload)
+    sum(x * x for x in xrange(200))
+
+
+def run_setup(log_mode, level, sample_every, eager, items):
+    """Run one setup in this process, logging to /dev/null, and print items/sec."""
+    sys.stderr = open(os.devnull, 'w')
+    listener = configure_logging(log_mode=log_mode, level=getattr(logging, level), sample_every=sample_every)
+    pool = ThreadPool(processes=PROCESSES)
+    start = time.time()
+    pool.map(lambda i: item(i, eager), xrange(items), chunksize=1)
+    pool.close()
+    pool.join()
+    # Count draining the log queue, or async logging would look better than it is
+    if listener:
+        listener.stop()
+    print items / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark logging overhead at migration concurrency.")
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--run", nargs=4, metavar=('MODE', 'LEVEL', 'SAMPLE_EVERY', 'EAGER'), help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.run:
+        log_mode, level, sample_every, eager = options.run
+        run_setup(log_mode, level, int(sample_every), eager == 'True', options.items)
+        return
+    # Each setup gets a fresh process so logging configuration doesn't leak between them
+    for name, log_mode, level, sample_every, eager in SETUPS:
+        output = subprocess.check_output([sys.executable, __file__, '--items', str(options.items),
+                                          '--run', log_mode, level, str(sample_every), str(eager)])
+        print '%-34s %8.0f items/sec' % (name, float(output.strip().splitlines()[-1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Record Desk and Zendesk traffic to a local archive and replay it, so runs can be compared without the live APIs.
+
+    python main.py --mode t --record run.jsonl.gz
+    python main.py --mode t --replay run.jsonl.gz --replay-speed 0 --run-stats current.json
+    python cassette.py baseline.json current.json --tolerance 0.1
+"""
+import argparse
+import base64
+import collections
+import gzip
+import hashlib
+import json
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+from requests.exceptions import RequestException, Timeout
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+# Never written to the archive - credentials and session state
+SCRUBBED_HEADERS = set(['authorization', 'set-cookie', 'cookie'])
+# Wait times in responses are scaled along with replay timing
+WAIT_HEADERS = ['retry-after', 'x-rate-limit-reset']
+
+
+class CassetteMiss(RequestException):
+    """A replayed run made a request that wasn't recorded."""
+
+
+def normalize_url(url):
+    # Sort query parameters so the key doesn't depend on dict ordering
+    parts = urlparse.urlsplit(url)
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+
+
+def request_keys(prepared):
+    """Exact key (including a hash of the body) and a looser one without it, for bodies that vary between runs."""
+    body = prepared.body or ''
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    loose = '%s %s' % (prepared.method, normalize_url(prepared.url))
+    return '%s %s' % (loose, hashlib.sha1(body).hexdigest()), loose
+
+
+class Cassette(object):
+    """Records responses to path, or replays them from it with the recorded latency multiplied by speed."""
+
+    def __init__(self, path, mode, speed=1.0):
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.misses = 0
+        self.started_at = time.time()
+        if mode == 'record':
+            self.archive = gzip.open(path, 'wb')
+        else:
+            self.exact = collections.defaultdict(collections.deque)
+            self.loose = collections.defaultdict(collections.deque)
+            with gzip.open(path, 'rb') as archive:
+                for line in archive:
+                    entry = json.loads(line)
+                    self.exact[entry['key']].append(entry)
+                    self.loose[entry['loose_key']].append(entry)
+
+    def send(self, session, prepared, timeout=None):
+        with self.lock:
+            self.requests += 1
+        if self.mode == 'record':
+            return self.record(session, prepared, timeout)
+        return self.replay(prepared)
+
+    def record(self, session, prepared, timeout=None):
+        start = time.time()
+        key, loose_key = request_keys(prepared)
+        try:
+            resp = session.send(prepared, timeout=timeout)
+        except Timeout:
+            # Recorded too, so a replay takes the same path
+            self.write({'key': key, 'loose_key': loose_key, 'timeout': True, 'elapsed': time.time() - start})
+            raise
+        self.write({
+            'key': key,
+            'loose_key': loose_key,
+            'status_code': resp.status_code,
+            'headers': dict((name, value) for name, value in resp.headers.iteritems() if name.lower() not in SCRUBBED_HEADERS),
+            'body': base64.b64encode(resp.content),
+            'elapsed': time.time() - start,
+        })
+        return resp
+
+    def write(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            self.archive.write(line)
+
+    def next_entry(self, prepared):
+        key, loose_key = request_keys(prepared)
+        with self.lock:
+            for entries in (self.exact.get(key), self.loose.get(loose_key)):
+                # Entries are in both indexes - skip ones already served through the other
+                while len(entries or ()) > 1 and entries[0].get('used'):
+                    entries.popleft()
+                if entries:
+                    # Repeat the last response once a key runs out, e.g. for extra polling or retries
+                    entry = entries.popleft() if len(entries) > 1 else entries[0]
+                    entry['used'] = True
+                    return entry
+            self.misses += 1
+        raise CassetteMiss("No recorded response for %s" % loose_key)
+
+    def replay(self, prepared):
+        entry = self.next_entry(prepared)
+        if self.speed:
+            time.sleep(entry['elapsed'] * self.speed)
+        if entry.get('timeout'):
+            raise Timeout("Recorded timeout for %s" % entry['loose_key'])
+        resp = Response()
+        resp.status_code = entry['status_code']
+        resp.headers = CaseInsensitiveDict(entry['headers'])
+        for header in WAIT_HEADERS:
+            if header in resp.headers:
+                try:
+                    resp.headers[header] = str(float(resp.headers[header]) * self.speed)
+                except ValueError:
+                    pass
+        resp._content = base64.b64decode(entry['body'])
+        resp.url = prepared.url
+        resp.request = prepared
+        return resp
+
+    def stats(self):
+        with self.lock:
+            return {'mode': self.mode, 'wall_seconds': time.time() - self.started_at, 'requests': self.requests, 'misses': self.misses}
+
+    def close(self):
+        if self.mode == 'record':
+            with self.lock:
+                self.archive.close()
+
+
+active_cassette = None
+
+
+def use_cassette(path, mode, speed=1.0):
+    global active_cassette
+    active_cassette = Cassette(path, mode, speed)
+    return active_cassette
+
+
+def send(session, prepared, timeout=None):
+    """session.send, through the active cassette if there is one."""
+    if active_cassette is None:
+        return session.send(prepared, timeout=timeout)
+    return active_cassette.send(session, prepared, timeout)
+
+
+def scale(seconds):
+    """seconds multiplied by the replay speed when replaying, so fixed waits speed up with the recorded latency."""
+    if active_cassette is None or active_cassette.mode != 'replay':
+        return seconds
+    return seconds * active_cassette.speed
+
+
+def sleep(seconds):
+    """time.sleep for waits that aren't in the recording, e.g. polling and retry backoff, scaled like replayed latency."""
+    seconds = scale(seconds)
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def compare_runs(baseline, current, tolerance):
+    """Regressions of current against baseline run stats, as messages. Empty if none."""
+    regressions = []
+    if current['misses']:
+        regressions.append("%d requests weren't in the recording" % current['misses'])
+    for metric in ('wall_seconds', 'requests'):
+        limit = baseline[metric] * (1 + tolerance)
+        if current[metric] > limit:
+            regressions.append("%s went from %.2f to %.2f (limit %.2f)" % (metric, baseline[metric], current[metric], limit))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail if a replayed run regressed against a baseline run.")
+    parser.add_argument("baseline", help="Run stats JSON from the baseline version")
+    parser.add_argument("current", help="Run stats JSON from the version under test")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed fractional increase in wall time and request count")
+    options = parser.parse_args()
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    with open(options.current) as f:
+        current = json.load(f)
+    regressions = compare_runs(baseline, current, options.tolerance)
+    for regression in regressions:
+        print "Regression: %s" % regression
+    if not regressions:
+        print "No regressions: %.2fs and %d requests (baseline %.2fs and %d requests)" % (
+            current['wall_seconds'], current['requests'], baseline['wall_seconds'], baseline['requests'])
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
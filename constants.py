@@ -4,3 +4,17 @@ ZENDESK_SITE = 'https://my-support-site.zendesk.com'
 MAX_RETRIES = 5
 PROCESSES = 100
 DEFAULT_WAIT_TIME = 60
+JOB_POLL_INTERVAL = 5
+JOB_POLL_ATTEMPTS = 60
+PRIORITY_PROCESSES = 10
+# Users that tickets are waiting on are posted in batches of up to this many, or whatever has arrived after this many seconds
+USER_BATCH_SIZE = 100
+USER_BATCH_WAIT = 2
+# Ticket import batches are packed up to these budgets; a ticket over either one is imported on its own.
+# Zendesk takes at most 100 tickets per create_many, so packing can't merge small tickets into fewer requests - it only
+# keeps large ones from failing a whole batch.
+MAX_IMPORT_TICKETS = 100
+MAX_IMPORT_BYTES = 4 * 1024 * 1024
+MAX_IMPORT_COMMENTS = 2000
+# Seconds to wait for a ticket import response - a batch that takes longer is split rather than retried whole
+IMPORT_TIMEOUT = 120
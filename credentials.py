@@ -0,0 +1,127 @@
+import getpass
+import json
+import os
+import threading
+import time
+
+# Credentials are resolved on first use (configure_auth, then the environment, then a prompt) so importing is side-effect free.
+pools_by_api = {}
+pools_lock = threading.Lock()
+
+
+def prompt_desk_auth():
+    return (os.environ.get('DESK_EMAIL') or raw_input('Desk email: '),
+            os.environ.get('DESK_PASSWORD') or getpass.getpass('Desk password: '))
+
+
+def prompt_zendesk_auth():
+    return ('%s/token' % (os.environ.get('ZENDESK_EMAIL') or raw_input('Zendesk email: ')),
+            os.environ.get('ZENDESK_TOKEN') or getpass.getpass('Zendesk token: '))
+
+
+AUTH_LOADERS = {
+    'desk': prompt_desk_auth,
+    'zendesk': prompt_zendesk_auth,
+}
+
+
+def load_credentials_file(api_name):
+    """Auth tuples for api_name from the JSON file in CREDENTIALS_FILE, e.g. {"desk": [["email", "password"], ...]}."""
+    filename = os.environ.get('CREDENTIALS_FILE')
+    if not filename:
+        return []
+    with open(filename) as f:
+        return [tuple(auth) for auth in json.load(f).get(api_name, [])]
+
+
+class Credential(object):
+    def __init__(self, auth, label):
+        self.auth = auth
+        self.label = label
+        self.remaining = None  # Unknown until the first response
+        self.blocked_until = 0
+        self.in_flight = 0
+
+
+class CredentialPool(object):
+    """Auth tuples for one API with rate-limit state tracked per credential.
+
+    Requests go to the credential with the most headroom, except pinned ones (e.g. Zendesk writes that must stay
+    attributable to one user), which always use the first credential.
+    """
+
+    def __init__(self, api_name, auths):
+        self.lock = threading.Lock()
+        if len(auths) == 1:
+            self.credentials = [Credential(auths[0], api_name)]
+        else:
+            self.credentials = [Credential(auth, '%s:%d' % (api_name, i)) for i, auth in enumerate(auths)]
+
+    def headroom(self, credential, now):
+        if credential.blocked_until > now:
+            return float('-inf')
+        if credential.remaining is None:
+            return float('inf')
+        return credential.remaining - credential.in_flight
+
+    def acquire(self, pinned=False):
+        with self.lock:
+            if pinned:
+                credential = self.credentials[0]
+            else:
+                now = time.time()
+                # Fewest requests in flight breaks ties, e.g. between credentials with no response yet at startup
+                credential = max(self.credentials, key=lambda c: (self.headroom(c, now), -c.in_flight))
+            credential.in_flight += 1
+            return credential
+
+    def release(self, credential, response, wait_resp_header, remaining_header, default_wait):
+        """Update credential's rate-limit state from response, which is None if the request failed."""
+        with self.lock:
+            credential.in_flight -= 1
+            if response is None:
+                return
+            remaining = response.headers.get(remaining_header)
+            if remaining is not None:
+                try:
+                    credential.remaining = int(remaining)
+                except ValueError:
+                    pass
+            if response.status_code == 429 or credential.remaining == 0:
+                try:
+                    wait = float(response.headers.get(wait_resp_header, default_wait))
+                except ValueError:
+                    wait = default_wait
+                credential.blocked_until = time.time() + wait
+
+    def wait_time(self, pinned=False):
+        """Seconds until a credential (the pinned one, if pinned) can be used again."""
+        with self.lock:
+            candidates = self.credentials[:1] if pinned else self.credentials
+            return max(min(c.blocked_until for c in candidates) - time.time(), 0)
+
+
+def configure_auth(desk=None, zendesk=None):
+    """Set auth up front, e.g. from a config object, instead of the environment or prompts.
+
+    Each argument is a (user, password) tuple or a list of them to spread requests over.
+    """
+    with pools_lock:
+        for api_name, auths in (('desk', desk), ('zendesk', zendesk)):
+            if auths:
+                if isinstance(auths, tuple):
+                    auths = [auths]
+                pools_by_api[api_name] = CredentialPool(api_name, [tuple(auth) for auth in auths])
+
+
+def get_credentials(api_name):
+    # Held while prompting so concurrent first requests only ask once
+    with pools_lock:
+        if api_name not in pools_by_api:
+            auths = load_credentials_file(api_name) or [AUTH_LOADERS[api_name]()]
+            pools_by_api[api_name] = CredentialPool(api_name, auths)
+        return pools_by_api[api_name]
+
+
+def get_auth(api_name):
+    return get_credentials(api_name).credentials[0].auth
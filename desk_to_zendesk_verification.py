@@ -1,19 +1,53 @@
-import getpass
+import argparse
+import json
 import logging
+import os
 import requests
+import sqlite3
+import tempfile
+
+from constants import ZENDESK_SITE
+from multiprocessing.pool import ThreadPool
+from pagination import DeskCursor
+from retryable_request import DeskCaseExportRequest, ZendeskIncrementalCommentRequest, \
+    ZendeskIncrementalTicketRequest, get_auth, handle_retries
 
 logger = logging.getLogger("zd_d_verifier")
 FORMAT = '[%(asctime)s] %(message)s'
-logging.basicConfig(level=logging.INFO, format=FORMAT)
 
-ZENDESK_SITE = 'https://mangohealth.zendesk.com'
 TICKET_STATUSES = ['open', 'solved', 'closed']
 ROLES = ['end-user', 'agent', 'admin']
+EXAMPLES_TO_LOG = 20
 
 get_headers = {
     'Accept': 'application/json',
 }
 
+# Each side is loaded into its own table of an on-disk index so the join doesn't need either side in memory.
+TABLES = {
+    'desk': ('CREATE TABLE IF NOT EXISTS desk (external_id TEXT PRIMARY KEY, comments INTEGER, attachments INTEGER)',
+             'INSERT OR REPLACE INTO desk VALUES (:external_id, :comments, :attachments)'),
+    'zendesk': ('CREATE TABLE IF NOT EXISTS zendesk (zendesk_id INTEGER PRIMARY KEY, external_id TEXT, comments INTEGER)',
+                'INSERT OR REPLACE INTO zendesk VALUES (:zendesk_id, :external_id, :comments)'),
+    'zendesk_attachments': ('CREATE TABLE IF NOT EXISTS zendesk_attachments (event_id INTEGER PRIMARY KEY, zendesk_id INTEGER, attachments INTEGER)',
+                            'INSERT OR REPLACE INTO zendesk_attachments VALUES (:event_id, :zendesk_id, :attachments)'),
+}
+
+REPORTS = {
+    'missing': '''SELECT desk.external_id, desk.comments, NULL FROM desk
+                  LEFT JOIN zendesk ON zendesk.external_id = desk.external_id
+                  WHERE zendesk.external_id IS NULL ORDER BY CAST(desk.external_id AS INTEGER)''',
+    'comment_mismatch': '''SELECT desk.external_id, desk.comments, MAX(zendesk.comments) FROM desk
+                           JOIN zendesk ON zendesk.external_id = desk.external_id
+                           GROUP BY desk.external_id HAVING MAX(zendesk.comments) < desk.comments ORDER BY CAST(desk.external_id AS INTEGER)''',
+    'attachment_gap': '''SELECT desk.external_id, desk.attachments, COALESCE(SUM(zendesk_attachments.attachments), 0) FROM desk
+                         JOIN zendesk ON zendesk.external_id = desk.external_id
+                         LEFT JOIN zendesk_attachments ON zendesk_attachments.zendesk_id = zendesk.zendesk_id
+                         WHERE desk.attachments > 0
+                         GROUP BY desk.external_id HAVING COALESCE(SUM(zendesk_attachments.attachments), 0) < desk.attachments
+                         ORDER BY CAST(desk.external_id AS INTEGER)''',
+}
+
 
 def get_tickets(zendesk_auth):
     tickets = {}
@@ -47,11 +81,153 @@ def get_users(zendesk_auth):
     return users
 
 
+def stream_pages(retryable_request, first_kwargs, next_kwargs):
+    """Yield pages of rows from a request whose on_success returns (rows, next), until next is empty.
+
+    Raises IOError if a page can't be fetched, since a partial stream would report false gaps.
+    """
+    kwargs = first_kwargs
+    while kwargs:
+        result = handle_retries(retryable_request=retryable_request, get_request_kwargs=kwargs)
+        if result is None:
+            raise IOError("Could not fetch %s with %s" % (retryable_request.__name__, kwargs))
+        rows, next_value = result
+        yield rows
+        kwargs = next_kwargs(next_value) if next_value else None
+
+
+def desk_case_pages():
+    """Desk cases by since_id, like the migration walks them, so deep pages cost no more than the first."""
+    cursor = DeskCursor(retryable_request=DeskCaseExportRequest, params={}, since_id=0, get_id=lambda row: int(row['external_id']))
+    for rows in cursor.pages():
+        yield rows
+    if not cursor.reached_end:
+        raise IOError("Could not fetch Desk cases after id %d" % cursor.since_id)
+
+
+def zendesk_ticket_pages():
+    return stream_pages(ZendeskIncrementalTicketRequest,
+                        {'params': {'start_time': 0, 'include': 'comment_count'}},
+                        lambda cursor: {'params': {'cursor': cursor, 'include': 'comment_count'}})
+
+
+def zendesk_attachment_pages():
+    return stream_pages(ZendeskIncrementalCommentRequest,
+                        {'params': {'start_time': 0, 'include': 'comment_events'}},
+                        lambda start_time: {'params': {'start_time': start_time, 'include': 'comment_events'}})
+
+
+def json_lines_pages(filename, page_size=1000):
+    """Local stand-in for the API streams: one JSON row per line, in the same shape the requests return."""
+    with open(filename) as f:
+        page = []
+        for line in f:
+            if line.strip():
+                page.append(json.loads(line))
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+
+def load_table(index_path, table, pages):
+    """Stream pages of rows into table, committing per page. Returns the number of rows loaded."""
+    insert_sql = TABLES[table][1]
+    connection = sqlite3.connect(index_path, timeout=300)
+    num_rows = 0
+    try:
+        for rows in pages:
+            for row in rows:
+                if row.get('external_id') is not None:
+                    row['external_id'] = str(row['external_id'])  # Zendesk returns external IDs as strings
+            connection.executemany(insert_sql, rows)
+            connection.commit()
+            num_rows += len(rows)
+    finally:
+        connection.close()
+    logger.info('Loaded %d %s rows' % (num_rows, table))
+    return num_rows
+
+
+def build_index(index_path, sources):
+    """Load every (table, pages) source into index_path in parallel."""
+    connection = sqlite3.connect(index_path)
+    connection.execute('PRAGMA journal_mode=WAL')  # Let the loaders write concurrently without blocking each other for long
+    for create_sql, _ in TABLES.values():
+        connection.execute(create_sql)
+    connection.execute('CREATE INDEX IF NOT EXISTS zendesk_external_id ON zendesk (external_id)')
+    connection.execute('CREATE INDEX IF NOT EXISTS zendesk_attachments_ticket ON zendesk_attachments (zendesk_id)')
+    connection.commit()
+    connection.close()
+    pool = ThreadPool(processes=len(sources))
+    results = [pool.apply_async(load_table, (index_path, table, pages)) for table, pages in sources.iteritems()]
+    pool.close()
+    try:
+        return [result.get() for result in results]
+    finally:
+        pool.join()
+
+
+def report_differences(index_path, report_file=None):
+    """Log and optionally write (as JSON lines) every ticket that's missing or short in Zendesk. Returns counts per kind."""
+    connection = sqlite3.connect(index_path)
+    counts = {}
+    out = open(report_file, 'w') if report_file else None
+    try:
+        for kind, sql in sorted(REPORTS.iteritems()):
+            counts[kind] = 0
+            for external_id, desk_count, zendesk_count in connection.execute(sql):
+                counts[kind] += 1
+                if counts[kind] <= EXAMPLES_TO_LOG:
+                    logger.info('%s: desk ticket %s (desk %s, zendesk %s)' % (kind, external_id, desk_count, zendesk_count))
+                if out:
+                    out.write(json.dumps({'kind': kind, 'external_id': external_id, 'desk': desk_count, 'zendesk': zendesk_count}) + '\n')
+            logger.info('Number of tickets with %s: %d' % (kind, counts[kind]))
+    finally:
+        connection.close()
+        if out:
+            out.close()
+    return counts
+
+
+def verify_tickets(sources, index_path=None, report_file=None):
+    """Diff Desk and Zendesk per ticket by external_id using an on-disk index. Returns counts per kind of difference."""
+    remove_index = index_path is None
+    if remove_index:
+        handle, index_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+    try:
+        build_index(index_path, sources)
+        return report_differences(index_path, report_file)
+    finally:
+        if remove_index:
+            for path in (index_path, index_path + '-wal', index_path + '-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
 def main():
-    zendesk_auth = ('%s/token' % raw_input('Zendesk email: '),
-                    getpass.getpass('Zendesk token: '))
-    get_tickets(zendesk_auth)
-    get_users(zendesk_auth)
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+    parser = argparse.ArgumentParser(description="Verify migrated tickets by diffing Desk and Zendesk per ticket.")
+    parser.add_argument("--counts-only", action="store_true", help="Only log Zendesk ticket and user counts")
+    parser.add_argument("--index", help="Keep the on-disk index here instead of a temporary file")
+    parser.add_argument("--report", help="Write every difference to this file as JSON lines")
+    parser.add_argument("--desk-file", help="Read Desk rows from a JSON lines file instead of the API")
+    parser.add_argument("--zendesk-file", help="Read Zendesk ticket rows from a JSON lines file instead of the API")
+    parser.add_argument("--zendesk-attachments-file", help="Read Zendesk attachment rows from a JSON lines file instead of the API")
+    options = parser.parse_args()
+    if options.counts_only:
+        get_tickets(get_auth('zendesk'))
+        get_users(get_auth('zendesk'))
+        return
+    sources = {
+        'desk': json_lines_pages(options.desk_file) if options.desk_file else desk_case_pages(),
+        'zendesk': json_lines_pages(options.zendesk_file) if options.zendesk_file else zendesk_ticket_pages(),
+        'zendesk_attachments': (json_lines_pages(options.zendesk_attachments_file) if options.zendesk_attachments_file
+                                else zendesk_attachment_pages()),
+    }
+    verify_tickets(sources, index_path=options.index, report_file=options.report)
 
 
 if __name__ == "__main__":
@@ -1,68 +1,253 @@
-from retryable_request import DeskAttachmentRequest, DeskCustomerRequest, \
+from retryable_request import DeskAttachmentRequest, DeskCustomerRequest, DeskIndividualCustomerRequest, \
     DeskMessageRequest, DeskTicketRequest, CheckUpload, ZendeskUpload, \
     ZendeskUserPostRequest, ZendeskTicketPostRequest, ZendeskTicketIDRequest, \
     ZendeskUpdateRequest, ZendeskTicketCommentCount, ZendeskVerification, ZendeskUserRequest, \
-    ZendeskSearch, handle_retries
+    ZendeskSearch, ZendeskJobStatusRequest, ZendeskTicketImportRequest, ZendeskUserShowManyRequest, configure_auth, handle_retries, \
+    send_with_retries
 
 import argparse
+import atexit
+import cassette
 import collections
 import json
 import logging
 import math
+import threading
 
 from Queue import Queue
+from batching import pack_tickets, split_batch
 from collections import defaultdict
 from collections import namedtuple
-from constants import AGENT_ID, PROCESSES
+from constants import AGENT_ID, JOB_POLL_ATTEMPTS, JOB_POLL_INTERVAL, PRIORITY_PROCESSES, PROCESSES, USER_BATCH_SIZE, USER_BATCH_WAIT
 from multiprocessing.pool import ThreadPool
+from pagination import DeskCursor
+from progress import PROGRESS, ProgressReporter
+from structured_logging import configure_structured_logging
+from user_dependencies import UserBatcher, UserDependencyTracker
 from zendesk_desk_models import ZMessageCreate, ZMessageUpdate, ZTicket, ZTicketUpdate, ZUser
 
 TICKET_STATUSES = ['open', 'closed']
 ROLES = ['end-user', 'agent', 'admin']
+MODES = ['u', 't', 'all']
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+JOB_DONE_STATUSES = ['completed', 'failed', 'killed']
+SPLIT_STATUS_CODES = [413, 422]  # Batch too large, or a ticket in it failed validation
 AttachmentTuple = namedtuple('AttachmentTuple', ['token', 'message_uri'])
 post_queue = Queue()
 update_queue = Queue()
 
 logger = logging.getLogger("migrate_to_zendesk")
 FORMAT = '[%(asctime)s] %(levelname)s %(thread)d %(message)s'
-logging.basicConfig(level=logging.INFO, format=FORMAT)
-POOL = ThreadPool(processes=PROCESSES)
+# Pools are started on first use so importing this module doesn't start any threads
+pools = {}
+pools_lock = threading.Lock()
 global_results = collections.deque()
 
 
-def migrate_user(desk_user):
-    logger.info("Creating user: %s" % desk_user.id)
+def configure_logging(log_mode='plain', level=logging.INFO, sample_every=1):
+    """Plain synchronous logging, or JSON lines written from a background thread with DEBUG records sampled.
+
+    Returns the structured mode's listener, which is stopped at exit; stop it sooner to flush on demand.
+    """
+    if log_mode == 'structured':
+        listener = configure_structured_logging(level=level, sample_every=sample_every)
+        atexit.register(listener.stop)
+        return listener
+    logging.basicConfig(level=level, format=FORMAT)
+
+
+def get_named_pool(name, processes):
+    with pools_lock:
+        if name not in pools:
+            pools[name] = ThreadPool(processes=processes)
+        return pools[name]
+
+
+def get_pool():
+    return get_named_pool('main', PROCESSES)
+
+
+def get_priority_pool():
+    """Users that queued tickets are waiting on are migrated here so they don't queue behind ticket work."""
+    return get_named_pool('priority', PRIORITY_PROCESSES)
+
+
+def close_pools():
+    """Wait for every pool to finish; the next get_pool() starts a fresh one."""
+    with pools_lock:
+        closing = pools.values()
+        pools.clear()
+    for pool in closing:
+        pool.close()
+    for pool in closing:
+        pool.join()
+
+
+def finish_pages(pages, ok=True):
+    """Tell the page each item came from (None if it didn't come from one) that it was sent, or couldn't be."""
+    for page in pages:
+        if page is None:
+            continue
+        if ok:
+            page.done()
+        else:
+            page.fail()
+
+
+def migrate_user(desk_user, page=None):
+    logger.debug("Creating user: %s", desk_user.id, extra={'user_id': desk_user.id})
     zd_user = ZUser()
     zd_user.desk_user_to_ZUser(user=desk_user)
-    post_queue.put(zd_user)
+    PROGRESS.add('converted')
+    post_queue.put((zd_user, page))
 
-    global_results.appendleft(POOL.apply_async(post_users_zendesk))
+    global_results.appendleft(get_pool().apply_async(post_users_zendesk))
 
 
 def post_users_zendesk(batch_size=100):
-    zendesk_users = []
     if post_queue.qsize() < batch_size:
         return
     logger.info("Posting %d users..." % batch_size)
-    zendesk_users.extend((post_queue.get().to_primitive()) for i in xrange(batch_size))
-    data = json.dumps({"users": zendesk_users})
-    handle_retries(retryable_request=ZendeskUserPostRequest, get_request_kwargs={'data': data})
+    queued = [post_queue.get() for i in xrange(batch_size)]
+    data = json.dumps({"users": [zd_user.to_primitive() for zd_user, page in queued]})
+    if handle_retries(retryable_request=ZendeskUserPostRequest, get_request_kwargs={'data': data}) is None:
+        PROGRESS.add('failed', len(queued))
+        finish_pages([page for zd_user, page in queued], ok=False)
+    else:
+        PROGRESS.add('posted', len(queued))
+        finish_pages([page for zd_user, page in queued])
+
+
+def lookup_priority_users(desk_user_ids, tracker, fetch_user):
+    """Confirm the users tickets are waiting on that are already in Zendesk with one lookup, and fetch the rest from Desk."""
+    external_ids = ','.join(str(desk_user_id) for desk_user_id in desk_user_ids)
+    zendesk_ids = handle_retries(retryable_request=ZendeskUserShowManyRequest, get_request_kwargs={'params': {'external_ids': external_ids}})
+    for desk_user_id in desk_user_ids:
+        if zendesk_ids is None:
+            fail_user(desk_user_id, tracker, retryable=True)
+        elif zendesk_ids.get(str(desk_user_id)):
+            tracker.confirm(desk_user_id, zendesk_ids[str(desk_user_id)])
+        else:
+            fetch_user(desk_user_id)
+
+
+def fetch_priority_user(desk_user_id, tracker, user_batcher):
+    """Fetch a Desk user that tickets are waiting on and add it to the next priority batch."""
+    logger.debug("Creating user ahead of tickets: %s", desk_user_id, extra={'user_id': desk_user_id})
+    desk_user, failure = send_with_retries(retryable_request=DeskIndividualCustomerRequest,
+                                           get_request_kwargs={'url': '/api/v2/customers/%s' % desk_user_id,
+                                                               'params': {'embed': 'facebook_user,twitter_user'}})
+    if failure is not None:
+        fail_user(desk_user_id, tracker, retryable=failure.status_code != 404)
+        return
+    zd_user = ZUser()
+    zd_user.desk_user_to_ZUser(user=desk_user)
+    user_batcher.add((desk_user_id, zd_user))
+
+
+def wait_for_job(job_id):
+    for i in xrange(JOB_POLL_ATTEMPTS):
+        status = handle_retries(retryable_request=ZendeskJobStatusRequest, get_request_kwargs={'url': "/api/v2/job_statuses/%s.json" % job_id})
+        if status in JOB_DONE_STATUSES:
+            return status
+        cassette.sleep(JOB_POLL_INTERVAL)
+    logger.error("Job %s did not finish" % job_id)
+
+
+def post_priority_users(users, tracker):
+    """Post a batch of (Desk user id, ZUser) in one job, wait for it, then confirm the users it created with one lookup."""
+    logger.info("Posting %d users that tickets are waiting on..." % len(users))
+    data = json.dumps({"users": [zd_user.to_primitive() for desk_user_id, zd_user in users]})
+    job_id = handle_retries(retryable_request=ZendeskUserPostRequest, get_request_kwargs={'data': data})
+    status = zendesk_ids = None
+    if job_id:
+        status = wait_for_job(job_id)
+        external_ids = ','.join(str(desk_user_id) for desk_user_id, zd_user in users)
+        zendesk_ids = handle_retries(retryable_request=ZendeskUserShowManyRequest, get_request_kwargs={'params': {'external_ids': external_ids}})
+    for desk_user_id, zd_user in users:
+        zd_user_id = (zendesk_ids or {}).get(str(desk_user_id))
+        if zd_user_id:
+            tracker.confirm(desk_user_id, zd_user_id)
+        else:
+            # Only a job that completed without creating the user means Zendesk rejected it, which a rerun won't change
+            fail_user(desk_user_id, tracker, retryable=status != 'completed' or zendesk_ids is None)
+
+
+def fail_user(desk_user_id, tracker, retryable=False):
+    """Drop the tickets waiting on a user that couldn't be migrated. If a rerun could migrate it, their pages hold the checkpoint."""
+    dropped = tracker.fail(desk_user_id, retryable)
+    PROGRESS.add('failed', len(dropped))
+    finish_pages([parked_ticket.page for parked_ticket in dropped], ok=not retryable)
+
+
+def ticket_user_ids(desk_ticket):
+    """Desk user ids that must exist in Zendesk before desk_ticket can be posted."""
+    user_ids = set([desk_ticket.user_id])
+    user_ids.update(message.creator_id for message in desk_ticket.messages if message.direction == 'in' and message.creator_id)
+    return user_ids
+
+
+def create_user_dependency_tracker(agent_id):
+    """Tracker for tickets waiting on users, and the batchers that look those users up and post the missing ones ahead of other work."""
+    def request_user(desk_user_id):
+        lookup_batcher.add(desk_user_id)
+
+    def lookup_batch(desk_user_ids):
+        global_results.appendleft(get_priority_pool().apply_async(lookup_priority_users, kwds={"desk_user_ids": desk_user_ids, "tracker": tracker,
+                                                                                               "fetch_user": fetch_user}))
+
+    def fetch_user(desk_user_id):
+        global_results.appendleft(get_priority_pool().apply_async(fetch_priority_user, kwds={"desk_user_id": desk_user_id, "tracker": tracker,
+                                                                                             "user_batcher": post_batcher}))
+
+    def post_batch(users):
+        global_results.appendleft(get_priority_pool().apply_async(post_priority_users, kwds={"users": users, "tracker": tracker}))
+
+    def release_ticket(desk_ticket, page):
+        user_ids = tracker.user_map(ticket_user_ids(desk_ticket))
+        global_results.appendleft(get_pool().apply_async(post_desk_ticket, kwds={"desk_ticket": desk_ticket, "agent": agent_id, "user_ids": user_ids,
+                                                                                  "page": page}))
+
+    tracker = UserDependencyTracker(request_user=request_user, release_ticket=release_ticket)
+    lookup_batcher = UserBatcher(post_batch=lookup_batch, max_size=USER_BATCH_SIZE, max_wait=cassette.scale(USER_BATCH_WAIT))
+    post_batcher = UserBatcher(post_batch=post_batch, max_size=USER_BATCH_SIZE, max_wait=cassette.scale(USER_BATCH_WAIT))
+    return tracker, [lookup_batcher, post_batcher]
 
 
-def migrate_ticket(ticket, agent):  # noqa
+def migrate_ticket(ticket, agent, tracker=None, page=None):
     desk_ticket = ticket_json_to_desk_obj(ticket)
     if not desk_ticket:
         return
+    if tracker is None:
+        post_desk_ticket(desk_ticket, agent, page=page)
+    # Wait for the ticket's users to be confirmed in Zendesk before converting it
+    elif not tracker.park(desk_ticket, ticket_user_ids(desk_ticket), page):
+        logger.error("Could not get creator_id for desk ticket %d...not posting or adding" % desk_ticket.id)
+        PROGRESS.add('failed')
+        finish_pages([page], ok=not tracker.retryable(ticket_user_ids(desk_ticket)))
+
+
+def post_desk_ticket(desk_ticket, agent, user_ids=None, page=None):  # noqa
     attachment_tuples = []
     for attachment in desk_ticket.attachments:
         content = handle_retries(retryable_request=CheckUpload, get_request_kwargs={'url': attachment.url})
         if content:
             uploaded_attachment = handle_retries(retryable_request=ZendeskUpload, get_request_kwargs={'params': {'filename': attachment.file_name}, 'data': content})
             attachment_tuples.append(AttachmentTuple(token=uploaded_attachment.get('upload', {}).get('token', ''), message_uri=attachment.message_uri))
-    zd_ticket = desk_ticket_to_ZTicket(ticket=desk_ticket, agent_id=agent, attachment_tuples=attachment_tuples)
+    lookup_failed = False
+    try:
+        zd_ticket = desk_ticket_to_ZTicket(ticket=desk_ticket, agent_id=agent, attachment_tuples=attachment_tuples, user_ids=user_ids)
+    except UserLookupFailed as e:
+        logger.error("Could not look up users for desk ticket %d: %s" % (desk_ticket.id, e))
+        zd_ticket, lookup_failed = None, True
     if not zd_ticket:
+        PROGRESS.add('failed')
+        # Tickets whose users aren't in Zendesk are replayed with upload_error_ticket.py once they're migrated,
+        # but a failed lookup holds the checkpoint so the next run retries it
+        finish_pages([page], ok=not lookup_failed)
         return
-    logger.info("Creating OR updating ticket: %d" % desk_ticket.id)
+    PROGRESS.add('converted')
+    logger.debug("Creating OR updating ticket: %d", desk_ticket.id, extra={'ticket_id': desk_ticket.id})
     id = handle_retries(retryable_request=ZendeskTicketIDRequest, get_request_kwargs={'url': "/api/v2/search.json",
                                                                                       'params': {'query': 'type:ticket external_id:%d' % desk_ticket.id}})
     # Ticket already exists
@@ -71,18 +256,25 @@ def migrate_ticket(ticket, agent):  # noqa
         num_comments = handle_retries(retryable_request=ZendeskTicketCommentCount, get_request_kwargs={'url': "/api/v2/tickets/%d.json" % (id),
                                                                                                        'params': {'include': 'comment_count'}})
         comments_to_add = len(zd_ticket.comments) - num_comments
-        logger.info("Adding %d comments to ticket %d already in zendesk" % (comments_to_add, id))
+        logger.debug("Adding %d comments to ticket %d already in zendesk", comments_to_add, id,
+                     extra={'ticket_id': desk_ticket.id, 'zendesk_ticket_id': id, 'comments': comments_to_add})
         if comments_to_add > 0:
             individual_tickets = create_ZTickets_for_comments(zd_ticket, comments_to_add)
-            [update_queue.put(i_ticket) for i_ticket in individual_tickets]
+            # Each comment update counts towards the page, so a failed one holds the checkpoint even if the status update works
+            if page is not None:
+                page.expect(len(individual_tickets))
+            [update_queue.put((i_ticket, page)) for i_ticket in individual_tickets]
         zd_ticket.comments = None
-        update_queue.put(zd_ticket)  # In all cases (new comment/no new comment), we should add the original ticket to update status/etc.
-        global_results.appendleft(POOL.apply_async(update_tickets_zendesk))
+        # In all cases (new comment/no new comment), we should add the original ticket to update status/etc.
+        update_queue.put((zd_ticket, page))
+        global_results.appendleft(get_pool().apply_async(update_tickets_zendesk))
     elif id == 0:
-        post_queue.put(zd_ticket)
-        global_results.appendleft(POOL.apply_async(post_tickets_zendesk))
+        post_queue.put((zd_ticket, page))
+        global_results.appendleft(get_pool().apply_async(post_tickets_zendesk))
     else:
         logger.error("Could not add ticket %d to the queue - checking existence failed" % desk_ticket.id)
+        PROGRESS.add('failed')
+        finish_pages([page], ok=id is not None)  # Only retry if the search itself failed, not on duplicates
 
 
 def ticket_json_to_desk_obj(ticket):
@@ -109,45 +301,65 @@ def ticket_json_to_desk_obj(ticket):
                                                           "url": "/api/v2/cases/%d/attachments" % (ticket.id)}))
     return ticket
 
-def desk_ticket_to_ZTicket(ticket, agent_id, attachment_tuples):  # noqa
+class UserLookupFailed(Exception):
+    """Searching Zendesk for a user failed, as opposed to finding that the user isn't there."""
+
+
+def get_zendesk_user_id(desk_user_id, user_ids=None):
+    """Zendesk id for a Desk user (0 if it isn't in Zendesk), from user_ids if already known, otherwise from search."""
+    if user_ids and desk_user_id in user_ids:
+        return user_ids[desk_user_id]
+    zd_user_id = handle_retries(retryable_request=ZendeskSearch, get_request_kwargs={"url": "/api/v2/search.json",
+                                                                                    "params": {"query": "type:user %d" % desk_user_id}})
+    if zd_user_id is None:
+        raise UserLookupFailed("search for user %s failed" % desk_user_id)
+    return zd_user_id
+
+
+def desk_ticket_to_ZTicket(ticket, agent_id, attachment_tuples, user_ids=None):  # noqa
     """Convert Desk Ticket object to Zendesk ZTicket object."""
     zmessages = []
-    creator_id = handle_retries(retryable_request=ZendeskSearch, get_request_kwargs={"url": "/api/v2/search.json",
-                                                                                     "params": {"query": "type:user %d" % ticket.user_id}})
+    desk_user_id = ticket.user_id
+    creator_id = get_zendesk_user_id(desk_user_id, user_ids)
     if creator_id == 0 or not creator_id:  # Must migrate users BEFORE migrating tickets
         logger.error("Could not get creator_id for desk ticket %d...not posting or adding" % ticket.id)
         return
-    remaining_attachments = attachment_tuples
+    # Group upload tokens by message once - schematics attribute access is slow, so each field is read once per item
+    uploads_by_message = defaultdict(list)
+    for at in attachment_tuples:
+        uploads_by_message[at.message_uri].append(at.token)
+    used_message_uris = set()
+    author_ids = {desk_user_id: creator_id}
     for message in ticket.messages:
-        if not message.body.strip():  # Zendesk requires all comments to have a body, but Desk does not have this requirement
-            message.body = "No message"
-        # we set created_at to updated_at because ZD has no draft message status, but Desk does.
-        zmessage = ZMessageCreate({'value': message.body, 'created_at': message.updated_at, 'author_id': agent_id, 'uploads': [], 'public': True}, strict=False, partial=False)
-        zmessage.uploads = [at.token for at in attachment_tuples if at.message_uri == message.uri]
-        remaining_attachments = [at for at in remaining_attachments if at.message_uri != message.uri]  # Remove attachment we just added
-        zmessage.author_id = agent_id
+        body = message.body
+        if not body.strip():  # Zendesk requires all comments to have a body, but Desk does not have this requirement
+            body = message.body = "No message"
+        uri = message.uri
+        used_message_uris.add(uri)
+        author_id = agent_id
         if message.direction == 'in':
-            zmessage.author_id = creator_id
-            if message.creator_id != ticket.user_id:
-                zd_user_id = handle_retries(retryable_request=ZendeskSearch, get_request_kwargs={"url": "/api/v2/search.json",
-                                            "params": {"query": "type:user %d" % message.creator_id}})
-                if zd_user_id:
-                    zmessage.author_id = zd_user_id
-                else:
-                    logger.error("Could not get creator_id for desk message %d...not posting or adding" % ticket.id)
-                    return
-        zmessages.append(zmessage)
+            message_creator_id = message.creator_id
+            if message_creator_id not in author_ids:
+                author_ids[message_creator_id] = get_zendesk_user_id(message_creator_id, user_ids)
+            author_id = author_ids[message_creator_id]
+            if not author_id:
+                logger.error("Could not get creator_id for desk message %d...not posting or adding" % ticket.id)
+                return
+        # we set created_at to updated_at because ZD has no draft message status, but Desk does.
+        zmessages.append(create_zmessage(body, message.updated_at, author_id, uploads_by_message.get(uri, []), True))
     for note in ticket.notes:
-        if not note.body.strip():
-            note.body = "No message"
-        zmessage = ZMessageCreate({'value': note.body, 'created_at': note.updated_at, 'author_id': agent_id, 'uploads': [], 'public': False}, strict=False, partial=False)
-        zmessages.append(zmessage)
+        body = note.body
+        if not body.strip():
+            body = note.body = "No message"
+        zmessages.append(create_zmessage(body, note.updated_at, agent_id, [], False))
 
-    zticket = ZTicket({'comments': zmessages, 'subject': ticket.subject, 'priority': 'low', 'status': ticket.status, 'external_id': ticket.id,
+    zticket = ZTicket({'subject': ticket.subject, 'priority': 'low', 'status': ticket.status, 'external_id': ticket.id,
                        'requester_id': creator_id, 'assignee_id': agent_id, 'tags': ['from_desk'],
                        'created_at': ticket.created_at, 'solved_at': ticket.resolved_at, 'updated_at': ticket.updated_at}, strict=False, partial=False)
+    # Assigned after construction so the already-converted comments aren't converted again
+    zticket.comments = zmessages
     # Leftover attachments with no associated reply get added onto first message
-    zticket.comments[0].uploads = [at.token for at in remaining_attachments]
+    zticket.comments[0].uploads = [at.token for at in attachment_tuples if at.message_uri not in used_message_uris]
     if 4 <= ticket.priority <= 6:
         zticket.priority = 'normal'
     elif 7 <= ticket.priority <= 9:
@@ -160,6 +372,17 @@ def desk_ticket_to_ZTicket(ticket, agent_id, attachment_tuples):  # noqa
     return zticket
 
 
+def create_zmessage(body, created_at, author_id, uploads, public):
+    """ZMessageCreate from values that are already the right types, skipping schematics' conversion of raw data."""
+    zmessage = ZMessageCreate()
+    zmessage.value = body
+    zmessage.created_at = created_at
+    zmessage.author_id = author_id
+    zmessage.uploads = uploads
+    zmessage.public = public
+    return zmessage
+
+
 def create_ZTickets_for_comments(zd_ticket, num_new):
     """Zendesk only updates one comment per API call, so create an object per ticket to update each comment"""
     zdtickets = []
@@ -173,72 +396,141 @@ def create_ZTickets_for_comments(zd_ticket, num_new):
 
 
 def post_tickets_zendesk(batch_size=100):
-    zendesk_tickets = []
     if post_queue.qsize() < batch_size:
         return
-    logger.info("Posting %d tickets..." % batch_size)
-    zendesk_tickets.extend((post_queue.get().to_primitive()) for i in xrange(batch_size))
-    data = json.dumps({"tickets": zendesk_tickets})
-    handle_retries(retryable_request=ZendeskTicketPostRequest, get_request_kwargs={'data': data})
+    queued = [post_queue.get() for i in xrange(batch_size)]
+    batches, oversized = pack_tickets([(json.dumps(ticket.to_primitive()), len(ticket.comments), page) for ticket, page in queued])
+    logger.info("Posting %d tickets in %d batches and %d single imports..." % (batch_size, len(batches), len(oversized)))
+    for batch in batches:
+        PROGRESS.record_batch(batch.num_bytes)
+        post_ticket_batch(batch)
+    for ticket_json, page in oversized:
+        PROGRESS.add_batch_metric('oversized')
+        post_single_ticket(ticket_json, page)
+
+
+def should_split(failure):
+    """Whether a failed batch might go through in smaller pieces, as opposed to failing again however it's sent."""
+    return failure.reason == 'timeout' or failure.status_code in SPLIT_STATUS_CODES
+
+
+def post_ticket_batch(batch):
+    result, failure = send_with_retries(retryable_request=ZendeskTicketPostRequest, get_request_kwargs={'data': batch.to_json()})
+    if failure is None:
+        PROGRESS.add('posted', len(batch.tickets))
+        finish_pages(batch.tags())
+    elif not should_split(failure):
+        logger.error("Could not post batch of %d tickets (%s %s)" % (len(batch.tickets), failure.reason, failure.status_code or ''))
+        PROGRESS.add('failed', len(batch.tickets))
+        finish_pages(batch.tags(), ok=False)
+    elif len(batch.tickets) > 1:
+        # Too large or slow for one request, or one of its tickets was rejected - retry each half on its own
+        logger.info("Splitting failed batch of %d tickets (%d bytes)" % (len(batch.tickets), batch.num_bytes))
+        PROGRESS.add_batch_metric('split_retries')
+        for half in split_batch(batch):
+            post_ticket_batch(half)
+    else:
+        ticket_json, num_comments, page = batch.tickets[0]
+        post_single_ticket(ticket_json, page)
+
+
+def post_single_ticket(ticket_json, page=None):
+    data = '{"ticket": %s}' % ticket_json
+    if handle_retries(retryable_request=ZendeskTicketImportRequest, get_request_kwargs={'data': data}) is not None:
+        PROGRESS.add('posted')
+        finish_pages([page])
+    else:
+        PROGRESS.add('failed')
+        finish_pages([page], ok=False)
 
 
 def update_tickets_zendesk(batch_size=100):
-    zendesk_tickets = []
     if update_queue.qsize() < batch_size:
         return
-    zendesk_tickets.extend(update_queue.get() for i in xrange(batch_size))
+    queued = [update_queue.get() for i in xrange(batch_size)]
     dedup_dict = defaultdict(list)  # One API call can't update the same ticket twice
-    for ticket in zendesk_tickets:
-        dedup_dict[ticket.id].append(ticket)
+    for ticket, page in queued:
+        dedup_dict[ticket.id].append((ticket, page))
     ztickets_deduped = []
+    pages = []
+    num_tickets = 0  # Desk tickets finished by this batch, as opposed to individual comment updates
     for id, item in dedup_dict.iteritems():
-        ztickets_deduped.append(item[0].to_primitive())
+        ticket, page = item[0]
+        ztickets_deduped.append(ticket.to_primitive())
+        pages.append(page)
+        if isinstance(ticket, ZTicket):
+            num_tickets += 1
         if len(item) > 1:
             logger.info("There were %d dupes" % (len(item) - 1))
             for dupe in item[1:]:
                 update_queue.put(dupe)
     logger.info("Updating ticket...")
     data = json.dumps({"tickets": ztickets_deduped})
-    logger.info(data)
-    handle_retries(retryable_request=ZendeskUpdateRequest, get_request_kwargs={'data': data})
+    logger.debug("Update payload: %s", data)
+    if handle_retries(retryable_request=ZendeskUpdateRequest, get_request_kwargs={'data': data}):
+        PROGRESS.add('updated', num_tickets)
+        finish_pages(pages)
+    else:
+        PROGRESS.add('failed', num_tickets)
+        finish_pages(pages, ok=False)
 
 
-def pool_controller(retryable_request, get_request_kwargs, agent_id):  # noqa
-    # Get first page and total number of apges
+def pool_controller(retryable_request, get_request_kwargs, agent_id, tracker=None, user_batchers=None, since_id=None, checkpoint_file=None):  # noqa
+    # Get first page and total number of pages - only used for progress, pages are walked by id below
     num_pages = handle_retries(retryable_request=retryable_request, get_pages=True, get_request_kwargs=get_request_kwargs)
     if not num_pages:
         logger.error("Error: Could not get number of pages")
         return
     logger.info("Number of pages %d" % num_pages)
-    for i in xrange(1, num_pages + 1):
-        logger.info("Processing page %d" % i)
-        # Returns list of dictionaries for ticket objects OR list of user objects
-        object_list = []
-        migrating_users = retryable_request == DeskCustomerRequest
-        if migrating_users:
-            kwargs = {'params': {'embed': 'facebook_user,twitter_user', 'page': i, 'per_page': 100}}
-        else:
-            kwargs = {'params': {'embed': 'customer, message', 'page': i, 'per_page': 100}}
-        object_list = POOL.apply(handle_retries,
-                                 kwds={"retryable_request": retryable_request,
-                                       "get_request_kwargs": kwargs})
+    migrating_users = retryable_request == DeskCustomerRequest
+    params = dict((key, value) for key, value in get_request_kwargs.get('params', {}).iteritems() if key not in ('page', 'per_page'))
+    cursor = DeskCursor(retryable_request=retryable_request, params=params, since_id=since_id, checkpoint_file=checkpoint_file)
+    if cursor.since_id:
+        # total_entries counts the whole collection, but this run only does what's after the cursor
+        logger.info("Resuming, so the number of items left and the ETA are unknown")
+        PROGRESS.set_total(None)
+    page_number = 0
+    # Returns list of ticket objects OR list of user objects
+    for object_list in cursor.pages():
+        page_number += 1
+        logger.info("Processing page %d" % page_number)
+        PROGRESS.add('enqueued', len(object_list))
+        # Each item finishes its page once it's been sent to Zendesk, not when it's queued, so a crash can't skip it
+        page = cursor.track(len(object_list))
         for elem in object_list:
             if migrating_users:
-                global_results.appendleft(POOL.apply_async(migrate_user, kwds={"desk_user": elem}))
+                global_results.appendleft(get_pool().apply_async(migrate_user, kwds={"desk_user": elem, "page": page}))
             else:
-                global_results.appendleft(POOL.apply_async(migrate_ticket, kwds={"ticket": elem, "agent": agent_id}))
-    while len(global_results) > 0:
-        result = global_results.pop()
-        result.get()
-    POOL.close()
-    POOL.join()
+                global_results.appendleft(get_pool().apply_async(migrate_ticket, kwds={"ticket": elem, "agent": agent_id, "tracker": tracker,
+                                                                                        "page": page}))
+    drain_results(user_batchers)
+    if tracker and tracker.pending():
+        logger.error("%d tickets still waiting on users that were never migrated" % tracker.pending())
+    close_pools()
     if migrating_users:
         post_func = post_users_zendesk
     else:
         post_func = post_tickets_zendesk
 
     flush_queues(post_func)
-    return num_pages
+    cursor.finish()
+    return page_number
+
+
+def drain_results(user_batchers=None):
+    """Wait for every scheduled task, including the ones they schedule in turn.
+
+    Tasks that schedule more work (users releasing parked tickets) do so before finishing, and users waiting for
+    a batch to fill are posted once everything else is done, since their tickets can't be released until then.
+    """
+    while True:
+        while len(global_results) > 0:
+            result = global_results.pop()
+            result.get()
+        for user_batcher in user_batchers or []:
+            user_batcher.flush()
+        if len(global_results) == 0:
+            return
 
 
 def flush_queues(post_func):
@@ -258,34 +550,87 @@ def flush_queues(post_func):
         post_func(batch_size=post_queue.qsize())
 
 
+def configure_cassette(options):
+    if options.record:
+        active = cassette.use_cassette(options.record, 'record')
+    elif options.replay:
+        active = cassette.use_cassette(options.replay, 'replay', speed=options.replay_speed)
+        # Recorded responses don't depend on credentials, so don't ask for any
+        configure_auth(desk=('replay', 'replay'), zendesk=('replay', 'replay'))
+    else:
+        return
+    atexit.register(finish_cassette, active, options.run_stats)
+
+
+def finish_cassette(active, run_stats):
+    active.close()
+    stats = active.stats()
+    logger.info("Run took %.2fs with %d requests (%d not recorded)" % (stats['wall_seconds'], stats['requests'], stats['misses']))
+    if run_stats:
+        with open(run_stats, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+
+
 def get_global_results():
     return global_results
 
 
 def main():
     parser = argparse.ArgumentParser(description="Migrate support tickets from desk to zendesk.")
-    parser.add_argument("--mode", help="Specify either (u)sers or (t)ickets to migrate")
+    parser.add_argument("--mode", help="Specify either (u)sers, (t)ickets, or all to migrate tickets along with the users they need")
+    parser.add_argument("--status-file", help="Write live progress as JSON to this file")
+    parser.add_argument("--progress-interval", type=int, default=30, help="Seconds between progress reports")
+    parser.add_argument("--checkpoint", help="Save the Desk id cursor to this file and resume from it if it exists")
+    parser.add_argument("--since-id", type=int, help="Only migrate Desk items with an id greater than this")
+    parser.add_argument("--log-mode", choices=['plain', 'structured'], default='plain',
+                        help="structured writes JSON lines from a background thread instead of formatting under the logging lock")
+    parser.add_argument("--log-level", type=str.upper, choices=LOG_LEVELS, default='INFO',
+                        help="Per-item events (each user, ticket, attachment) are logged at DEBUG")
+    parser.add_argument("--log-sample-every", type=int, default=1, help="In structured mode, keep one in every N DEBUG records")
+    parser.add_argument("--record", help="Record every API response to this archive")
+    parser.add_argument("--replay", help="Serve API responses from this archive instead of calling the APIs")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="Multiply recorded latency and wait times by this when replaying, 0 for none")
+    parser.add_argument("--run-stats", help="Write wall time and request count for this run to this file as JSON")
     options = parser.parse_args()
+    configure_logging(log_mode=options.log_mode, level=getattr(logging, options.log_level), sample_every=options.log_sample_every)
+    configure_cassette(options)
     mode = options.mode
-    # hardcode the agent from which all tickets are being posted
-    agent_id = handle_retries(retryable_request=ZendeskUserRequest, get_request_kwargs={"url": "/api/v2/users/%s" % AGENT_ID})
-    if mode == 'u':
-        pool_controller(retryable_request=DeskCustomerRequest, agent_id=agent_id, get_request_kwargs={'params': {'embed': 'facebook_user,twitter_user', 'page': 1, 'per_page': 100}})
-    elif mode == 't':
-        pool_controller(retryable_request=DeskTicketRequest, agent_id=agent_id, get_request_kwargs={'params': {'embed': 'customer, message', 'page': 1, 'per_page': 100}})
-    else:
+    if mode not in MODES:
         logger.error("Unsupported mode %s" % mode)
         return
+    tracker = None
+    user_batchers = []
+    reporter = ProgressReporter(interval=options.progress_interval, status_file=options.status_file,
+                                queue_sizes=lambda: {'post': post_queue.qsize(), 'update': update_queue.qsize(),
+                                                     'parked': tracker.pending() if tracker else 0,
+                                                     'user_batches': sum(user_batcher.pending() for user_batcher in user_batchers)})
+    # hardcode the agent from which all tickets are being posted
+    agent_id = handle_retries(retryable_request=ZendeskUserRequest, get_request_kwargs={"url": "/api/v2/users/%s" % AGENT_ID})
+    reporter.start()
+    # Always write the final report, so a crashed run's status file shows how far it got
+    try:
+        if mode == 'u':
+            pool_controller(retryable_request=DeskCustomerRequest, agent_id=agent_id, get_request_kwargs={'params': {'embed': 'facebook_user,twitter_user', 'page': 1, 'per_page': 100}},
+                            since_id=options.since_id, checkpoint_file=options.checkpoint)
+        elif mode == 't':
+            pool_controller(retryable_request=DeskTicketRequest, agent_id=agent_id, get_request_kwargs={'params': {'embed': 'customer, message', 'page': 1, 'per_page': 100}},
+                            since_id=options.since_id, checkpoint_file=options.checkpoint)
+        elif mode == 'all':
+            tracker, user_batchers = create_user_dependency_tracker(agent_id)
+            pool_controller(retryable_request=DeskTicketRequest, agent_id=agent_id, get_request_kwargs={'params': {'embed': 'customer, message', 'page': 1, 'per_page': 100}},
+                            tracker=tracker, user_batchers=user_batchers, since_id=options.since_id, checkpoint_file=options.checkpoint)
+    finally:
+        reporter.stop()
 
     logger.info('Complete: All pages processed')
-    if mode == 't':
+    if mode in ('t', 'all'):
         for status in TICKET_STATUSES:
             num_tickets = handle_retries(retryable_request=ZendeskVerification, get_request_kwargs={'params': {'query': 'type:ticket status:%s' % status}})
             if not num_tickets:
                 logger.error("Verification failed")
                 return
             logger.info('Number of %s tickets in Zendesk: %s' % (status, num_tickets))
-    else:
+    if mode in ('u', 'all'):
         for role in ROLES:
             num_users = handle_retries(retryable_request=ZendeskVerification, get_request_kwargs={'params': {'query': 'type:user role:%s' % role}})
             if not num_users:
@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+
+from retryable_request import handle_retries
+
+logger = logging.getLogger("migrate_to_zendesk")
+
+PER_PAGE = 100
+
+
+def read_checkpoint(checkpoint_file):
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return 0
+    with open(checkpoint_file) as f:
+        return int(f.read().strip() or 0)
+
+
+def write_checkpoint(checkpoint_file, since_id):
+    # Write then rename so a crash never leaves a half-written checkpoint
+    tmp_file = '%s.tmp' % checkpoint_file
+    with open(tmp_file, 'w') as f:
+        f.write('%d\n' % since_id)
+    os.rename(tmp_file, checkpoint_file)
+
+
+class Page(object):
+    """A page of Desk items that the checkpoint can only move past once every item has been sent to Zendesk."""
+
+    def __init__(self, cursor, start, size):
+        self.cursor = cursor
+        self.start = start  # since_id the page was fetched with
+        self.remaining = size
+        self.failed = False
+
+    def expect(self, count):
+        """count more items must be sent before this page is done, e.g. the comment updates a ticket turned into."""
+        with self.cursor.lock:
+            self.remaining += count
+
+    def done(self, count=1):
+        """count of this page's items were posted or updated, or can never be (e.g. their user couldn't be migrated)."""
+        self.cursor.finish_items(self, count)
+
+    def fail(self, count=1):
+        """count of this page's items couldn't be sent - the checkpoint stays before this page so a rerun retries them."""
+        self.cursor.finish_items(self, count, failed=True)
+
+
+class DeskCursor(object):
+    """Walks a Desk collection in id order with since_id instead of page numbers.
+
+    Every request asks for the first page after the cursor, so fetch latency doesn't grow with depth and items
+    created mid-run can't shift page boundaries and cause skips or repeats.
+
+    If checkpoint_file is given, the cursor before the oldest page that still has items waiting to be sent (see
+    track) is saved there, and a later run resumes from it.
+    """
+
+    def __init__(self, retryable_request, params, since_id=None, checkpoint_file=None, get_id=None):
+        self.retryable_request = retryable_request
+        self.params = params
+        self.get_id = get_id or (lambda elem: int(elem.id))
+        self.reached_end = False  # False if pages() stopped because a page couldn't be fetched
+        self.checkpoint_file = checkpoint_file
+        self.since_id = since_id if since_id is not None else read_checkpoint(checkpoint_file)
+        self.page_start = self.since_id
+        self.tracked_id = self.since_id  # Last id of the newest page passed to track
+        self.lock = threading.Lock()
+        self.pending = []  # Tracked pages with items not yet sent, oldest first
+
+    def pages(self):
+        if self.since_id:
+            logger.info("Resuming after id %d" % self.since_id)
+        while True:
+            params = dict(self.params, since_id=self.since_id, sort_field='id', sort_direction='asc', page=1, per_page=PER_PAGE)
+            object_list = handle_retries(retryable_request=self.retryable_request,
+                                         get_request_kwargs={'url': '/search', 'params': params})
+            if object_list is None:
+                logger.error("Error: Could not get page after id %d" % self.since_id)
+                return
+            # Never go backwards, even if the API hands back something at or before the cursor
+            object_list = [elem for elem in object_list if self.get_id(elem) > self.since_id]
+            if not object_list:
+                self.reached_end = True
+                return
+            self.page_start = self.since_id
+            self.since_id = max(self.get_id(elem) for elem in object_list)
+            yield object_list
+
+    def track(self, size):
+        """Page for the size items just yielded. Call its done() or fail() for each item once it's been sent."""
+        with self.lock:
+            page = Page(self, self.page_start, size)
+            self.pending.append(page)
+            self.tracked_id = self.since_id
+        return page
+
+    def finish_items(self, page, count, failed=False):
+        with self.lock:
+            page.remaining -= count
+            page.failed = page.failed or failed
+            finished = False
+            while self.pending and self.pending[0].remaining <= 0 and not self.pending[0].failed:
+                self.pending.pop(0)
+                finished = True
+            if finished and self.checkpoint_file:
+                write_checkpoint(self.checkpoint_file, self.checkpoint())
+
+    def checkpoint(self):
+        # Called with the lock held
+        return self.pending[0].start if self.pending else self.tracked_id
+
+    def finish(self):
+        with self.lock:
+            if self.pending:
+                logger.error("Checkpoint held at id %d - %d pages have items that failed or were never sent" % (self.checkpoint(), len(self.pending)))
+            if self.checkpoint_file:
+                write_checkpoint(self.checkpoint_file, self.checkpoint())
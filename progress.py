@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("migrate_to_zendesk")
+
+STAGES = ['enqueued', 'converted', 'posted', 'updated', 'failed']
+BATCH_METRICS = ['batches', 'batch_bytes', 'max_batch_bytes', 'split_retries', 'oversized']
+# Stages that mean a Desk item is finished with, for ETA purposes
+DONE_STAGES = ['posted', 'updated', 'failed']
+RATE_LIMIT_HEADERS = {
+    'limit': 'X-Rate-Limit-Limit',
+    'remaining': 'X-Rate-Limit-Remaining',
+    'reset': 'X-Rate-Limit-Reset',
+}
+
+
+class Progress(object):
+    """Thread-safe counters for each migration stage plus the last rate-limit headroom seen per API."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = dict((stage, 0) for stage in STAGES)
+            self.batch_metrics = dict((metric, 0) for metric in BATCH_METRICS)
+            self.rate_limits = {}
+            self.total = 0
+            self.started_at = time.time()
+
+    def set_total(self, total):
+        with self.lock:
+            self.total = int(total) if total is not None else None
+
+    def add(self, stage, count=1):
+        with self.lock:
+            self.counts[stage] += count
+
+    def record_batch(self, num_bytes):
+        with self.lock:
+            self.batch_metrics['batches'] += 1
+            self.batch_metrics['batch_bytes'] += num_bytes
+            self.batch_metrics['max_batch_bytes'] = max(self.batch_metrics['max_batch_bytes'], num_bytes)
+
+    def add_batch_metric(self, metric, count=1):
+        with self.lock:
+            self.batch_metrics[metric] += count
+
+    def record_rate_limit(self, api_name, headers):
+        if not api_name:
+            return
+        headroom = {}
+        for key, header in RATE_LIMIT_HEADERS.iteritems():
+            value = headers.get(header)
+            if value is None and key == 'limit':
+                value = headers.get('X-Rate-Limit')  # Zendesk doesn't use the -Limit suffix
+            if value is not None:
+                try:
+                    headroom[key] = int(value)
+                except ValueError:
+                    pass
+        if headroom:
+            with self.lock:
+                self.rate_limits[api_name] = headroom
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counts': dict(self.counts),
+                'batch_metrics': dict(self.batch_metrics),
+                'rate_limits': dict((api, dict(headroom)) for api, headroom in self.rate_limits.iteritems()),
+                'total': self.total,
+                'elapsed': time.time() - self.started_at,
+            }
+
+
+PROGRESS = Progress()
+
+
+class ProgressReporter(threading.Thread):
+    """Logs a progress line and rewrites status_file every interval seconds until stopped.
+
+    queue_sizes is an optional callable returning {name: size} for queues worth watching for backlog.
+    """
+
+    def __init__(self, progress=PROGRESS, interval=30, status_file=None, queue_sizes=None):
+        super(ProgressReporter, self).__init__(name="progress-reporter")
+        self.daemon = True
+        self.progress = progress
+        self.interval = interval
+        self.status_file = status_file
+        self.queue_sizes = queue_sizes
+        self.stopped = threading.Event()
+        self.last = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.report()
+
+    def status(self):
+        snapshot = self.progress.snapshot()
+        counts = snapshot['counts']
+        elapsed = snapshot['elapsed']
+        if self.last:
+            window = elapsed - self.last['elapsed']
+            previous = self.last['counts']
+        else:
+            window = elapsed
+            previous = dict((stage, 0) for stage in STAGES)
+        rates = {}
+        for stage in STAGES:
+            rates[stage] = (counts[stage] - previous[stage]) / window if window > 0 else 0.0
+        done = sum(counts[stage] for stage in DONE_STAGES)
+        done_rate = done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if snapshot['total'] and done_rate > 0:
+            eta = max(snapshot['total'] - done, 0) / done_rate
+        self.last = snapshot
+        batch_metrics = snapshot['batch_metrics']
+        if batch_metrics['batches']:
+            batch_metrics['avg_batch_bytes'] = batch_metrics['batch_bytes'] / batch_metrics['batches']
+        return {
+            'updated_at': time.time(),
+            'elapsed_seconds': round(elapsed, 1),
+            'total': snapshot['total'],
+            'done': done,
+            'counts': counts,
+            'items_per_second': dict((stage, round(rate, 2)) for stage, rate in rates.iteritems()),
+            'rate_limits': snapshot['rate_limits'],
+            'batches': batch_metrics,
+            'queues': self.queue_sizes() if self.queue_sizes else {},
+            'eta_seconds': int(round(eta)) if eta is not None else None,
+        }
+
+    def report(self):
+        status = self.status()
+        counts = status['counts']
+        rates = status['items_per_second']
+        headroom = ' '.join('%s=%s/%s' % (api, limits.get('remaining', '?'), limits.get('limit', '?'))
+                            for api, limits in sorted(status['rate_limits'].iteritems()))
+        eta = '%ds' % status['eta_seconds'] if status['eta_seconds'] is not None else 'unknown'
+        batches = status['batches']
+        logger.info("Progress %d/%s done | %s | rate-limit %s | queues %s | batches %d avg %d bytes, %d split, %d oversized | ETA %s" % (
+            status['done'], status['total'] if status['total'] is not None else 'unknown',
+            ' '.join('%s=%d (%.1f/s)' % (stage, counts[stage], rates[stage]) for stage in STAGES),
+            headroom or 'unknown', status['queues'], batches['batches'], batches.get('avg_batch_bytes', 0),
+            batches['split_retries'], batches['oversized'], eta))
+        if self.status_file:
+            write_status_file(self.status_file, status)
+        return status
+
+
+def write_status_file(path, status):
+    # Write then rename so readers never see a half-written file
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
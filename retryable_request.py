@@ -1,9 +1,12 @@
-import getpass
+import cassette
 import logging
 import requests
 import time
 
-from constants import DEFAULT_WAIT_TIME, DESKSITE, MAX_RETRIES, ZENDESK_SITE
+from collections import namedtuple
+from constants import DEFAULT_WAIT_TIME, DESKSITE, IMPORT_TIMEOUT, MAX_RETRIES, ZENDESK_SITE
+from credentials import configure_auth, get_auth, get_credentials  # noqa
+from progress import PROGRESS
 from zendesk_desk_models import Attachment, FBUser, Message, Ticket, TwitUser, User
 
 GET_HEADERS = {
@@ -19,13 +22,10 @@ POST_HEADERS = {
 }
 
 logger = logging.getLogger("migrate_to_zendesk")
+# Why send_with_retries gave up: 'timeout', 'rate_limited', 'status' (see status_code) or 'error'
+RequestFailure = namedtuple('RequestFailure', ['reason', 'status_code'])
 
-# Didn't want to implement metaclasses so chose to use module-level authentication.
-desk_auth = (raw_input('Desk email: '),
-             getpass.getpass('Desk password: '))
-
-zendesk_auth = ('%s/token' % raw_input('Zendesk email: '),
-                getpass.getpass('Zendesk token: '))
+# Didn't want to implement metaclasses so chose to use module-level authentication, see credentials.py.
 
 
 class RetryableRequest(object):
@@ -33,11 +33,15 @@ class RetryableRequest(object):
     method = "get"
     params = {}
     headers = {}
-    auth = tuple()
     wait_resp_header = ""
+    remaining_resp_header = 'X-Rate-Limit-Remaining'
+    api_name = ""  # Picks the credential pool to use
+    pinned = False  # Always use the first credential, e.g. for writes that must be attributable to one user
+    timeout = None  # Seconds to wait for a response, None to wait forever
+    retry_timeouts = True  # False to give up on the first timeout, e.g. so the caller can send less instead
 
     @classmethod
-    def get_request(cls, url=None, data=None, params=None):
+    def get_request(cls, url=None, data=None, params=None, auth=None):
         if not data:
             data = {}
         if not params:
@@ -47,7 +51,13 @@ class RetryableRequest(object):
         else:
             new_url = "%s%s" % (cls.url, url)
 
-        return requests.Request(method=cls.method, url=new_url, data=data, params=params, headers=cls.headers, auth=cls.auth)
+        return requests.Request(method=cls.method, url=new_url, data=data, params=params, headers=cls.headers, auth=auth or cls.get_auth())
+
+    @classmethod
+    def get_auth(cls):
+        if not cls.api_name:
+            return None
+        return get_auth(cls.api_name)
 
     @classmethod
     def on_success(cls, resp):
@@ -60,13 +70,13 @@ class RetryableRequest(object):
 
 class DeskRequest(RetryableRequest):
     wait_resp_header = 'X-Rate-Limit-Reset'
-    auth = desk_auth
+    api_name = 'desk'
     headers = GET_HEADERS
 
 
 class ZendeskRequest(RetryableRequest):
-    auth = zendesk_auth
     wait_resp_header = 'retry-after'
+    api_name = 'zendesk'
 
 
 def desk_customer_to_schematics(entry, embedded_key):
@@ -130,16 +140,17 @@ class DeskIndividualTicketRequest(DeskTicketRequest):
 
 class CheckUpload(RetryableRequest):
     url = ""
-    auth = desk_auth
+    api_name = 'desk'
 
     @classmethod
     def on_success(cls, response):
-        logger.info("Successfully got image")
+        logger.debug("Successfully got image")
         return response.content
 
 
 class ZendeskUpload(ZendeskRequest):
     method = 'post'
+    pinned = True
     headers = UPLOAD_HEADERS
     url = "%s/api/v2/uploads.json" % ZENDESK_SITE
 
@@ -150,12 +161,15 @@ class ZendeskUpload(ZendeskRequest):
 
 class ZendeskPostRequest(ZendeskRequest):
     method = 'post'
+    pinned = True
     headers = POST_HEADERS
 
     @classmethod
     def on_success(cls, response):
         logger.info("Successfully posted - posted tickets or users")
-        logger.info("Job ID %s" % response.json().get('job_status', {}).get('id', 0))
+        job_id = response.json().get('job_status', {}).get('id', 0)
+        logger.info("Job ID %s", job_id)
+        return job_id
 
 
 class ZendeskUserPostRequest(ZendeskPostRequest):
@@ -164,16 +178,44 @@ class ZendeskUserPostRequest(ZendeskPostRequest):
 
 class ZendeskTicketPostRequest(ZendeskPostRequest):
     url = "%s/api/v2/imports/tickets/create_many.json" % ZENDESK_SITE
+    timeout = IMPORT_TIMEOUT
+    retry_timeouts = False  # post_ticket_batch splits the batch instead
+
+
+class ZendeskTicketImportRequest(ZendeskRequest):
+    """Single ticket import, for tickets too large to share a create_many batch."""
+    method = 'post'
+    pinned = True
+    headers = POST_HEADERS
+    url = "%s/api/v2/imports/tickets.json" % ZENDESK_SITE
+    timeout = IMPORT_TIMEOUT
+
+    @classmethod
+    def on_success(cls, response):
+        logger.debug("Successfully posted - imported single ticket")
+        return response.json().get('ticket', {}).get('id', 0)
+
+
+class ZendeskJobStatusRequest(ZendeskRequest):
+    headers = GET_HEADERS
+    url = ZENDESK_SITE
+
+    @classmethod
+    def on_success(cls, response):
+        data = response.json()
+        return data.get('job_status', {}).get('status', '')
 
 
 class ZendeskUpdateRequest(ZendeskRequest):
     method = 'put'
+    pinned = True
     headers = POST_HEADERS
     url = "%s/api/v2/tickets/update_many.json" % ZENDESK_SITE
 
     @classmethod
     def on_success(cls, response):
         logger.info("Successfully posted - updated tickets")
+        return True
 
 
 class DeskMessageRequest(DeskRequest):
@@ -195,9 +237,9 @@ class DeskMessageRequest(DeskRequest):
                     try:
                         message.creator_id = int(path[4])
                     except ValueError:
-                        logger.info("Could not find creator ID of message - not posting message %s" % entry)
+                        logger.info("Could not find creator ID of message - not posting message %s", entry)
                 else:
-                    logger.info("Could not find creator ID of message - not posting message %s" % entry)
+                    logger.info("Could not find creator ID of message - not posting message %s", entry)
             message_list.append(message)
         return message_list
 
@@ -252,6 +294,17 @@ class ZendeskUserRequest(ZendeskRequest):
         return data.get("user", {}).get('id', 0)
 
 
+class ZendeskUserShowManyRequest(ZendeskRequest):
+    """Zendesk user ids by external ID, for up to 100 external IDs per request."""
+    headers = GET_HEADERS
+    url = "%s/api/v2/users/show_many.json" % ZENDESK_SITE
+
+    @classmethod
+    def on_success(cls, response):
+        users = response.json().get('users', [])
+        return dict((user.get('external_id'), user.get('id')) for user in users if user.get('external_id'))
+
+
 class ZendeskSearch(ZendeskRequest):
     url = ZENDESK_SITE
 
@@ -263,6 +316,57 @@ class ZendeskSearch(ZendeskRequest):
         return data['results'][0].get('id', 0)
 
 
+class DeskCaseExportRequest(DeskRequest):
+    """Lightweight per-case counts for verification."""
+    url = "%s/api/v2/cases" % DESKSITE
+
+    @classmethod
+    def on_success(cls, response):
+        data = response.json()
+        rows = []
+        for entry in data.get('_embedded', {}).get('entries', []):
+            links = entry.get('_links', {})
+            rows.append({'external_id': entry.get('id'),
+                         # First message + replies + notes, which each become a Zendesk comment
+                         'comments': 1 + links.get('replies', {}).get('count', 0) + links.get('notes', {}).get('count', 0),
+                         'attachments': links.get('attachments', {}).get('count', 0)})
+        return rows
+
+
+class ZendeskIncrementalTicketRequest(ZendeskRequest):
+    headers = GET_HEADERS
+    url = "%s/api/v2/incremental/tickets/cursor.json" % ZENDESK_SITE
+
+    @classmethod
+    def on_success(cls, response):
+        data = response.json()
+        rows = []
+        for ticket in data.get('tickets', []):
+            if ticket.get('status') == 'deleted' or ticket.get('external_id') is None:
+                continue
+            rows.append({'zendesk_id': ticket.get('id'), 'external_id': ticket.get('external_id'),
+                         'comments': ticket.get('comment_count', 0)})
+        next_cursor = None if data.get('end_of_stream') else data.get('after_cursor')
+        return rows, next_cursor
+
+
+class ZendeskIncrementalCommentRequest(ZendeskRequest):
+    headers = GET_HEADERS
+    url = "%s/api/v2/incremental/ticket_events.json" % ZENDESK_SITE
+
+    @classmethod
+    def on_success(cls, response):
+        data = response.json()
+        rows = []
+        for event in data.get('ticket_events', []):
+            for child in event.get('child_events', []):
+                if child.get('event_type') == 'Comment' and child.get('attachments'):
+                    rows.append({'event_id': child.get('id'), 'zendesk_id': event.get('ticket_id'),
+                                 'attachments': len(child.get('attachments'))})
+        next_start_time = None if data.get('end_of_stream') else data.get('end_time')
+        return rows, next_start_time
+
+
 class ZendeskVerification(ZendeskRequest):
     url = "%s/api/v2/search.json" % ZENDESK_SITE
 
@@ -271,44 +375,77 @@ class ZendeskVerification(ZendeskRequest):
         data = response.json()
         return data.get('count', -1)
 
-def handle_retries(retryable_request, get_request_kwargs=None, remaining_retries=MAX_RETRIES, get_pages=False):  # noqa
+def send_request(session, retryable_request, get_request_kwargs):
+    """Send with the credential that has the most rate-limit headroom and record what the response says is left."""
+    if not retryable_request.api_name:
+        request = retryable_request.get_request(**get_request_kwargs)
+        return request, cassette.send(session, request.prepare(), timeout=retryable_request.timeout)
+    credentials = get_credentials(retryable_request.api_name)
+    credential = credentials.acquire(pinned=retryable_request.pinned)
+    request = retryable_request.get_request(auth=credential.auth, **get_request_kwargs)
+    resp = None
+    try:
+        resp = cassette.send(session, request.prepare(), timeout=retryable_request.timeout)
+    finally:
+        credentials.release(credential, resp, retryable_request.wait_resp_header, retryable_request.remaining_resp_header,
+                             cassette.scale(DEFAULT_WAIT_TIME))
+    PROGRESS.record_rate_limit(credential.label, resp.headers)
+    return request, resp
+
+
+def handle_retries(retryable_request, get_request_kwargs=None, remaining_retries=MAX_RETRIES, get_pages=False):
+    return send_with_retries(retryable_request, get_request_kwargs, remaining_retries, get_pages)[0]
+
+
+def send_with_retries(retryable_request, get_request_kwargs=None, remaining_retries=MAX_RETRIES, get_pages=False):  # noqa
+    """handle_retries, returning (result, failure) where failure is a RequestFailure saying why it gave up, or None."""
     # Create a new session each time to be threadsafe/allow more connections
     session = requests.Session()
-    request = retryable_request.get_request(**get_request_kwargs)
     try:
-        resp = session.send(request.prepare())
+        request, resp = send_request(session, retryable_request, get_request_kwargs)
     except requests.exceptions.Timeout:
+        if not retryable_request.retry_timeouts:
+            logger.info("Timed out after %ss for %s" % (retryable_request.timeout, retryable_request))
+            return None, RequestFailure('timeout', None)
         if remaining_retries <= 0:
             logger.error("Ran out of retries for %s" % retryable_request)
-            return
+            return None, RequestFailure('timeout', None)
         logger.info("Sleeping for %d" % DEFAULT_WAIT_TIME)
-        time.sleep(DEFAULT_WAIT_TIME)
-        return handle_retries(retryable_request=retryable_request,
-                              get_request_kwargs=get_request_kwargs,
-                              remaining_retries=remaining_retries - 1)
+        cassette.sleep(DEFAULT_WAIT_TIME)
+        return send_with_retries(retryable_request=retryable_request,
+                                 get_request_kwargs=get_request_kwargs,
+                                 remaining_retries=remaining_retries - 1,
+                                 get_pages=get_pages)
     except requests.exceptions.RequestException:
         logger.exception("Caught unexpected exception for %s" % retryable_request)
-        return
+        return None, RequestFailure('error', None)
     except:
         logger.exception("Caught unexpected exception for %s" % retryable_request)
-        return
+        return None, RequestFailure('error', None)
     if resp.ok:
         # For first API call to get total pages in desk/zendesk
         if get_pages:
             entries = resp.json().get('total_entries')
             logger.info('Total entries to process: %d' % entries)
-            return (int(entries) / 100) + 1
-        return retryable_request.on_success(resp)
+            PROGRESS.set_total(entries)
+            return (int(entries) / 100) + 1, None
+        return retryable_request.on_success(resp), None
     if resp.status_code == 429:
         if remaining_retries <= 0:
             logger.error("Ran out of retries for %s" % retryable_request)
-            return
-        time_to_sleep = float(resp.headers.get(retryable_request.wait_resp_header, DEFAULT_WAIT_TIME))
-        logger.info("Sleeping for %d" % time_to_sleep)
-        time.sleep(time_to_sleep)
-        return handle_retries(retryable_request=retryable_request,
-                              get_request_kwargs=get_request_kwargs,
-                              remaining_retries=remaining_retries - 1)
+            return None, RequestFailure('rate_limited', resp.status_code)
+        if retryable_request.api_name:
+            # Retry straight away on another credential if one has headroom left
+            time_to_sleep = get_credentials(retryable_request.api_name).wait_time(pinned=retryable_request.pinned)
+        else:
+            time_to_sleep = float(resp.headers.get(retryable_request.wait_resp_header, cassette.scale(DEFAULT_WAIT_TIME)))
+        if time_to_sleep > 0:
+            logger.info("Sleeping for %d" % time_to_sleep)
+            time.sleep(time_to_sleep)
+        return send_with_retries(retryable_request=retryable_request,
+                                 get_request_kwargs=get_request_kwargs,
+                                 remaining_retries=remaining_retries - 1,
+                                 get_pages=get_pages)
     else:
         logger.exception("Unhandled status code %d for %s" % (resp.status_code, retryable_request.on_failure(request, resp)))
-        return
+        return None, RequestFailure('status', resp.status_code)
@@ -0,0 +1,119 @@
+import itertools
+import json
+import logging
+import threading
+
+from Queue import Queue
+
+# Attributes every LogRecord has - anything else on a record came from extra= and is emitted as a field
+STANDARD_RECORD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | set(['message', 'asctime'])
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line with the standard fields plus anything passed with extra=."""
+
+    def format(self, record):
+        event = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.thread,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.iteritems():
+            if key not in STANDARD_RECORD_ATTRIBUTES:
+                event[key] = value
+        if record.exc_info:
+            event['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            event['exception'] = record.exc_text
+        return json.dumps(event, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep one in every sample_every per-item (DEBUG) records; anything more important always passes."""
+
+    def __init__(self, sample_every):
+        super(SamplingFilter, self).__init__()
+        self.sample_every = sample_every
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.sample_every <= 1:
+            return True
+        return next(self.counter) % self.sample_every == 0
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to a QueueListener so worker threads never wait on formatting or I/O for other threads."""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def handle(self, record):
+        # Unlike Handler.handle, don't take the handler lock around emit - the queue is already thread-safe, and
+        # holding a lock shared by every thread while the message is formatted is the contention this avoids
+        if not self.filter(record):
+            return False
+        self.emit(record)
+        return True
+
+    def emit(self, record):
+        try:
+            # Resolve the message now, since args may change once the caller moves on
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Drains a queue of records into handlers on a single background thread."""
+
+    sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="log-listener")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self.sentinel:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Flush everything queued so far and stop the thread."""
+        if not self.thread or not self.thread.is_alive():
+            return
+        self.queue.put(self.sentinel)
+        self.thread.join()
+
+
+def configure_structured_logging(level=logging.INFO, sample_every=1, stream=None):
+    """Log JSON lines through a queue, sampling DEBUG records. Returns the listener, which should be stopped at exit."""
+    queue = Queue()
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JSONFormatter())
+    listener = QueueListener(queue, output)
+    handler = QueueHandler(queue)
+    handler.addFilter(SamplingFilter(sample_every))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    listener.start()
+    return listener
@@ -1,4 +1,5 @@
 import argparse
+import collections
 import logging
 import main
 
@@ -9,47 +10,71 @@ from retryable_request import DeskIndividualCustomerRequest, DeskIndividualTicke
 logger = logging.getLogger("migrate_to_zendesk")
 
 
-def get_customers(ticket):
+BATCH_SIZE = 100
+
+
+def search_tickets(desk_ticket_ids):
+    desk_ticket_models = handle_retries(retryable_request=DeskIndividualTicketRequest,
+                                        get_request_kwargs={'url': '/api/v2/cases/search',
+                                                            'params': {'embed': 'customer, message', 'page': 1, 'per_page': BATCH_SIZE,
+                                                                       'case_id': ','.join(desk_ticket_ids)}})
+    if desk_ticket_models is None:
+        logger.error("Could not get desk tickets %s" % ','.join(desk_ticket_ids))
+        return []
+    return desk_ticket_models
+
+
+def get_customer(user_id):
     desk_user_model = handle_retries(retryable_request=DeskIndividualCustomerRequest,
-                                     get_request_kwargs={'url': '/api/v2/customers/%s' % ticket.user_id,
+                                     get_request_kwargs={'url': '/api/v2/customers/%s' % user_id,
                                                          'params': {'embed': 'facebook_user,twitter_user'}})
-    logger.info("Adding customer external id %s" % desk_user_model.id)
+    if not desk_user_model:
+        logger.error("Could not get desk customer %s" % user_id)
+        return
+    logger.debug("Adding customer external id %s", desk_user_model.id, extra={'user_id': desk_user_model.id})
     migrate_user(desk_user_model)
 
 
 def main_upload():
-    POOL = main.POOL
     global_results = get_global_results()
     parser = argparse.ArgumentParser(description="Migrate leftover support tickets from desk to zendesk.")
     parser.add_argument("--mode", help="Specify either (u)sers or (t)ickets to migrate")
     parser.add_argument('--filename', help="Specify file to read broken tickets from")
     options = parser.parse_args()
+    main.configure_logging()
     mode = options.mode
     filename = options.filename
+    if mode == 'u':
+        post_func = post_users_zendesk
+    elif mode == 't':
+        post_func = post_tickets_zendesk
+    else:
+        logger.error("Unsupported mode %s" % mode)
+        return
+    pool = main.get_pool()
     agent_id = handle_retries(retryable_request=ZendeskUserRequest, get_request_kwargs={"url": "/api/v2/users/%s" % AGENT_ID})
     with open(filename) as f:
-        desk_ticket_ids = [line.strip() for line in f]
-
-    for i in xrange(0, len(desk_ticket_ids), 100):
-        comma_sep_tickets = ','.join(desk_ticket_ids[i: i + 100])
-        desk_ticket_models = handle_retries(retryable_request=DeskIndividualTicketRequest,
-                                            get_request_kwargs={'url': '/api/v2/cases/search',
-                                                                'params': {'embed': 'customer, message', 'page': 1, 'per_page': 100, 'case_id': comma_sep_tickets}})
+        # Dedupe while keeping file order
+        desk_ticket_ids = list(collections.OrderedDict((line.strip(), None) for line in f if line.strip()))
 
-        for ticket in desk_ticket_models:
+    # Run every search at once - results are folded into the normal batchers as each one comes back, in whatever order
+    searches = pool.imap_unordered(search_tickets, [desk_ticket_ids[i: i + BATCH_SIZE] for i in xrange(0, len(desk_ticket_ids), BATCH_SIZE)])
+    seen_user_ids = set()  # Many broken tickets share a customer - only fetch each one once
+    for tickets in searches:
+        for ticket in tickets:
             if mode == 'u':
-                post_func = post_users_zendesk
-                global_results.appendleft(POOL.apply_async(get_customers, kwds={"ticket": ticket}))
-            elif mode == 't':
-                logger.info("Adding ticket external id %s" % ticket.id)
-                post_func = post_tickets_zendesk
-                global_results.appendleft(POOL.apply_async(migrate_ticket, kwds={"ticket": ticket, "agent": agent_id}))
+                if ticket.user_id in seen_user_ids:
+                    continue
+                seen_user_ids.add(ticket.user_id)
+                global_results.appendleft(pool.apply_async(get_customer, kwds={"user_id": ticket.user_id}))
+            else:
+                logger.debug("Adding ticket external id %s", ticket.id, extra={'ticket_id': ticket.id})
+                global_results.appendleft(pool.apply_async(migrate_ticket, kwds={"ticket": ticket, "agent": agent_id}))
 
     while len(global_results) > 0:
         result = global_results.pop()
         result.get()
-    POOL.close()
-    POOL.join()
+    main.close_pools()
 
     flush_queues(post_func)
 
@@ -0,0 +1,143 @@
+import logging
+import threading
+
+from collections import defaultdict
+
+logger = logging.getLogger("migrate_to_zendesk")
+
+
+class ParkedTicket(object):
+    """Desk ticket waiting on one or more of its users to exist in Zendesk."""
+
+    def __init__(self, ticket, missing_user_ids, page=None):
+        self.ticket = ticket
+        self.missing_user_ids = set(missing_user_ids)
+        self.page = page
+
+
+class UserDependencyTracker(object):
+    """Tracks which Desk users are confirmed in Zendesk and which tickets are parked waiting on them.
+
+    ``request_user`` is called once per missing Desk user id and should schedule that user's migration.
+    ``release_ticket`` is called with the Desk ticket and the page it was parked with once all of its users are confirmed.
+    """
+
+    def __init__(self, request_user, release_ticket):
+        self.request_user = request_user
+        self.release_ticket = release_ticket
+        self.lock = threading.Lock()
+        self.zendesk_ids = {}  # Desk user id -> Zendesk user id
+        self.failed = {}  # Desk user id -> whether a rerun could still migrate it (e.g. the API was down, not a 404)
+        self.in_flight = set()
+        self.parked = defaultdict(list)  # Desk user id -> [ParkedTicket]
+
+    def user_map(self, desk_user_ids):
+        with self.lock:
+            return dict((desk_id, self.zendesk_ids[desk_id]) for desk_id in desk_user_ids if desk_id in self.zendesk_ids)
+
+    def known(self, desk_user_id):
+        with self.lock:
+            return desk_user_id in self.zendesk_ids
+
+    def park(self, ticket, desk_user_ids, page=None):
+        """Park ticket until all desk_user_ids are confirmed. Returns False if the ticket can never be released."""
+        to_request = []
+        with self.lock:
+            missing = [desk_id for desk_id in desk_user_ids if desk_id not in self.zendesk_ids]
+            if any(desk_id in self.failed for desk_id in missing):
+                return False
+            if not missing:
+                ready = True
+            else:
+                ready = False
+                parked_ticket = ParkedTicket(ticket, missing, page)
+                for desk_id in missing:
+                    self.parked[desk_id].append(parked_ticket)
+                    if desk_id not in self.in_flight:
+                        self.in_flight.add(desk_id)
+                        to_request.append(desk_id)
+        if ready:
+            self.release_ticket(ticket, page)
+        for desk_id in to_request:
+            logger.debug("Ticket %d is waiting on user %s - migrating user first", ticket.id, desk_id, extra={'ticket_id': ticket.id, 'user_id': desk_id})
+            self.request_user(desk_id)
+        return True
+
+    def confirm(self, desk_user_id, zendesk_user_id):
+        released = []
+        with self.lock:
+            self.zendesk_ids[desk_user_id] = zendesk_user_id
+            self.in_flight.discard(desk_user_id)
+            for parked_ticket in self.parked.pop(desk_user_id, []):
+                parked_ticket.missing_user_ids.discard(desk_user_id)
+                if not parked_ticket.missing_user_ids:
+                    released.append(parked_ticket)
+        for parked_ticket in released:
+            self.release_ticket(parked_ticket.ticket, parked_ticket.page)
+
+    def retryable(self, desk_user_ids):
+        """Whether any of desk_user_ids failed in a way a rerun could fix."""
+        with self.lock:
+            return any(self.failed.get(desk_id) for desk_id in desk_user_ids)
+
+    def fail(self, desk_user_id, retryable=False):
+        """Drop tickets waiting on desk_user_id and return their ParkedTickets."""
+        with self.lock:
+            self.failed[desk_user_id] = retryable
+            self.in_flight.discard(desk_user_id)
+            dropped = self.parked.pop(desk_user_id, [])
+            # Stop waiting on this ticket's other users as well
+            for parked_ticket in dropped:
+                for other_id in parked_ticket.missing_user_ids:
+                    if other_id != desk_user_id and parked_ticket in self.parked.get(other_id, []):
+                        self.parked[other_id].remove(parked_ticket)
+        for parked_ticket in dropped:
+            logger.error("Could not get creator_id for desk ticket %d...user %s could not be migrated" % (parked_ticket.ticket.id, desk_user_id))
+        return dropped
+
+    def pending(self):
+        with self.lock:
+            return len(set(parked_ticket for tickets in self.parked.values() for parked_ticket in tickets))
+
+
+class UserBatcher(object):
+    """Collects users to handle in one request, handing each batch to post_batch once it's full or max_wait seconds old.
+
+    post_batch is called with the lock held, so it should only schedule the post; once flush() returns, every
+    batch taken so far (including by the timer) has been handed over.
+    """
+
+    def __init__(self, post_batch, max_size, max_wait):
+        self.post_batch = post_batch
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.users = []
+        self.timer = None
+
+    def add(self, user):
+        with self.lock:
+            self.users.append(user)
+            if len(self.users) >= self.max_size:
+                self.hand_over()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.hand_over()
+
+    def hand_over(self):
+        # Called with the lock held
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.users:
+            batch, self.users = self.users, []
+            self.post_batch(batch)
+
+    def pending(self):
+        with self.lock:
+            return len(self.users)
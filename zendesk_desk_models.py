@@ -2,11 +2,12 @@ from schematics.models import Model
 from schematics.types import StringType, DateTimeType, IntType, URLType, BooleanType
 from schematics.types.compound import ListType, ModelType
 import datetime
-from django.utils.encoding import force_bytes
 import logging
 from urlparse import urlsplit
 
 logger = logging.getLogger("migrate_to_zendesk")
+# Computed once at import - the date the migration runs, so it's the same for every user however many threads convert them
+DESK_USER_TAG = 'desk_user_before_%s' % str(datetime.datetime.now().date())
 
 
 class FBUser(Model):
@@ -78,15 +79,16 @@ class ZUser(Model):
         self.identities = zidentities
         self.verified = True
         self.remote_photo_url = user.avatar
-        self.tags = ['desk_user_before_%s' % str(datetime.datetime.now().date())]
+        self.tags = [DESK_USER_TAG]
 
         return self
 
 
 def get_fb_id_from_photo(url):
+    from django.utils.encoding import force_bytes  # Deferred - only Facebook users need it and it's slow to import
     str_url = force_bytes(url)
     parsed = urlsplit(str_url)  # urlsplit doesn't work with unicode strings
-    logger.info(parsed)
+    logger.debug("Parsed Facebook photo URL %s", parsed)
     if parsed.netloc != 'graph.facebook.com':
         logger.error("Photo URL isn't from facebook - falling back on using entire URL %s" % str_url)
         return url